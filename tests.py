@@ -10,7 +10,8 @@ Released under GPL v3.
 (c) 2023 by Mathieu Brèthes
 """
 
-import unittest, os, tempfile, difflib,shutil, time, logging, inspect
+import unittest, os, tempfile, difflib,shutil, time, logging, inspect, io
+from unittest import mock
 from vc import VerConRepository, VerConDirectory, VerConError, VerConFile
 
 class TestConstructor(unittest.TestCase):
@@ -129,6 +130,23 @@ class TestConstructor(unittest.TestCase):
         rep = VerConRepository(childdir2)
         self.assertTrue(rep.getBaseDir(), childdir)
         self.assertTrue(rep.getRepoDir(), repodir2)
+        
+    def test_metadataLineEndings(self):
+        """
+        metadatadir.txt is cut on \n only: Windows ends of lines and a final \n are accepted, and the other
+        line separators known to Python (form feed, unicode line separator...) stay in the directory names.
+        """
+        logging.info("Running %s"%inspect.currentframe().f_code.co_name)
+        repodir = os.path.join(self.tempDir.name, "REPO")
+        os.mkdir(repodir)
+        os.mkdir(os.path.join(repodir, "DATA"))
+        with open(os.path.join(repodir, "metadatadir.txt"),"w", encoding="utf-8", newline="") as f:
+            f.write("1 dir\u2028one\r\n 1 sub\x0ctwo\r\n1 three\n")
+        with open(os.path.join(repodir, "commits.txt"),"w", encoding="utf-8", newline="") as f:
+            f.write("1. commit\n\n")
+            
+        rep = VerConRepository(self.tempDir.name)
+        self.assertEqual(rep.dirDb.Serialize(), ["1 dir\u2028one", " 1 sub\x0ctwo", "1 three"])
 
 class TestLogging(unittest.TestCase):
     """
@@ -239,6 +257,12 @@ class TestVerConDirectory(unittest.TestCase):
         
         with self.assertRaises(VerConError):
             self.assertTrue(good.atPath("unobtain") != None)     
+        
+        # the same lookup without an exception.
+        self.assertTrue(good.tryAtPath("test") is good.atPath("test"))
+        self.assertEqual(good.tryAtPath(""), good)
+        self.assertEqual(good.tryAtPath("unobtain"), None)
+        self.assertEqual(good.tryAtPath(os.path.join("test", "unobtain")), None)
             
     def test_endOfLines(self):
         """
@@ -306,6 +330,11 @@ class TestVerConDirectory(unittest.TestCase):
         # now check if children functionnality works
         dir = dirs.atPath("test")
         self.assertTrue(dir.atPath("subtest").isCurrentlyActive())
+        
+        # and if paths are known from the root
+        self.assertEqual(dirs.getPath(), "")
+        self.assertEqual(dir.getPath(), "test")
+        self.assertEqual(dir.atPath("subtest").getPath(), os.path.join("test", "subtest"))
 
         # then a test with 2 first-level directory
         dirs = VerConDirectory(["1 test", "1 test2"])
@@ -314,6 +343,13 @@ class TestVerConDirectory(unittest.TestCase):
         with self.assertRaises(VerConError):
             self.assertTrue(dirs.atPath(os.path.join("test", "test2")).isCurrentlyActive())
             
+        # children added out of order are written in order.
+        dirs.Add("a", 2)
+        self.assertEqual(dirs.Serialize(), ["2 a", "1 test", "1 test2"])
+        # and a history that changes is written again.
+        dirs.atPath("test").toggleState(3)
+        self.assertEqual(dirs.Serialize(), ["2 a", "1,3 test", "1 test2"])
+            
 
     def test_addDir(self):
         """
@@ -371,6 +407,12 @@ class TestVerConDirectory(unittest.TestCase):
         dirs.Add(os.path.join("zorgl", "bleh", "bar"), 3)
         self.assertEqual(dirs.Serialize(), updd)
         
+        # the stream written into metadatadir.txt is the same as the pretty printout
+        out = io.StringIO()
+        dirs.serializeTo(out)
+        self.assertEqual(out.getvalue(), "\n".join(updd))
+        self.assertEqual(out.getvalue(), dirs.__repr__())
+        
 
 
 class TestCommitDirectories(unittest.TestCase):
@@ -677,6 +719,27 @@ class TestCommitFiles(unittest.TestCase):
             self.assertEqual(f.read(), datab)       
             
             
+    def test_commitTwiceSameRepository(self):
+        """
+        Successive commits done with the same repository object: a file or a directory deleted after the first
+        commit must be seen as deleted by the second one.
+        """
+        logging.info("Running %s"%inspect.currentframe().f_code.co_name)
+        vc = VerConRepository(self.tempDir.name)
+        
+        os.mkdir(os.path.join(self.tempDir.name, "dir"))
+        with open(os.path.join(self.tempDir.name, "textfile.txt"), "w", encoding="utf-8", newline="") as f:
+            f.write(self.datat)
+        vc.commit("first")
+        
+        os.unlink(os.path.join(self.tempDir.name, "textfile.txt"))
+        os.rmdir(os.path.join(self.tempDir.name, "dir"))
+        vc.commit("second")
+        
+        self.assertEqual(vc.getLastCommit(), 2)
+        self.assertTrue(os.path.isfile(os.path.join(vc.getDataDir(), "D2- textfile.txt")), "D2- textfile.txt not created in REPO/DATA")
+        self.assertFalse(vc.dirDb.atPath("dir").isCurrentlyActive())
+
     def test_commitFileCheckEncoding(self):
         """
         This test checks that the files are stored as Text or Binary depending on their encoding.
@@ -1014,6 +1077,75 @@ class TestRetrievePreviousData(unittest.TestCase):
         with open(os.path.join(self.tempDir.name,"test.txt"), "r", encoding="utf-8", newline="") as f:
             self.assertEqual(f.read(),"moo")
         
+    def test_failsIfNewFileInDeletedSubdirectory(self):
+        """
+        ensure restore does not happen if a file was added and not committed in a subdirectory of a directory that
+        did not exist at the revision restored.
+        """
+        logging.info("Running %s"%inspect.currentframe().f_code.co_name)
+        with open(os.path.join(self.tempDir.name,"test.txt"), "w", encoding="utf-8", newline="") as f:
+            f.write(self.datat)
+            
+        vc = VerConRepository(self.tempDir.name)
+        vc.commit("revision 1")
+        
+        os.makedirs(os.path.join(self.tempDir.name,"testdir","subdir"))
+        with open(os.path.join(self.tempDir.name,"testdir","subdir","test2.txt"), "w", encoding="utf-8", newline="") as f:
+            f.write(self.datat2)    
+
+        vc = VerConRepository(self.tempDir.name)
+        vc.commit("revision 2")       
+
+        with open(os.path.join(self.tempDir.name,"testdir","subdir","new.txt"), "w", encoding="utf-8", newline="") as f:
+            f.write("moo")
+            
+        vc = VerConRepository(self.tempDir.name)
+        with self.assertRaises(VerConError):
+            vc.restoreTo(1)
+        
+        with open(os.path.join(self.tempDir.name,"testdir","subdir","new.txt"), "r", encoding="utf-8", newline="") as f:
+            self.assertEqual(f.read(),"moo")
+        self.assertTrue(os.path.isfile(os.path.join(self.tempDir.name,"testdir","subdir","test2.txt")))
+        
+    def test_failsIfNewFileAfterVanishedDirectory(self):
+        """
+        ensure a directory removed while the user space is checked before a restore only skips that directory:
+        the files not committed in the other directories are still found.
+        """
+        logging.info("Running %s"%inspect.currentframe().f_code.co_name)
+        with open(os.path.join(self.tempDir.name,"test.txt"), "w", encoding="utf-8", newline="") as f:
+            f.write(self.datat)
+            
+        vc = VerConRepository(self.tempDir.name)
+        vc.commit("revision 1")
+        
+        for d in ("a", "b"):
+            os.makedirs(os.path.join(self.tempDir.name,"testdir",d))
+            with open(os.path.join(self.tempDir.name,"testdir",d,"test2.txt"), "w", encoding="utf-8", newline="") as f:
+                f.write(self.datat2)    
+
+        vc = VerConRepository(self.tempDir.name)
+        vc.commit("revision 2")       
+
+        # both get a new file, the first one walked vanishes.
+        for d in ("a", "b"):
+            with open(os.path.join(self.tempDir.name,"testdir",d,"new.txt"), "w", encoding="utf-8", newline="") as f:
+                f.write("moo")
+        
+        scandir = os.scandir
+        vanished = []
+        def vanishOnce(path):
+            if len(vanished) == 0 and os.path.dirname(path) == os.path.join(self.tempDir.name,"testdir"):
+                vanished.append(path)
+                raise FileNotFoundError(path)
+            return scandir(path)
+            
+        vc = VerConRepository(self.tempDir.name)
+        with mock.patch("os.scandir", side_effect=vanishOnce):
+            with self.assertRaises(VerConError):
+                vc.dirDb.CheckModifiedOrNewFilesInDir(1, self.tempDir.name, "testdir")
+        self.assertEqual(len(vanished), 1)
+        
     def test_twoCommitsAndARestoreText(self):
         """
         We commit a text file and a binary file twice, and see if we can restore the version of first commit.
@@ -1752,6 +1884,33 @@ class testVerConFile(unittest.TestCase):
         data = vcf.contentsAt(1)
         self.assertEqual(data,self.t1)   
 
+    def test_storedFileAt(self):
+        """
+        Checks which revisions are stored as-is in a data file (E files and binary history), and which ones
+        have to be computed (text history).
+        """
+        logging.info("Running %s"%inspect.currentframe().f_code.co_name)
+
+        with open(os.path.join(self.rootDir, "test.tst"), "wb") as f:
+            f.write(self.b1)
+            
+        vcf = VerConFile("test.tst", self.rootDir, self.dataDir, "")
+        vcf.createAtRevision(1)
+        
+        with open(os.path.join(self.rootDir, "test.tst"), "w", encoding="utf-8", newline="") as f:
+            f.write(self.t1)
+        vcf.changeAtRevision(2)
+        
+        with open(os.path.join(self.rootDir, "test.tst"), "w", encoding="utf-8", newline="") as f:
+            f.write(self.t2)
+        vcf.changeAtRevision(3)
+        
+        self.assertIsNone(vcf.storedFileAt(0))
+        self.assertEqual(vcf.storedFileAt(1), os.path.join(self.dataDir, "HB1- test.tst"))
+        self.assertIsNone(vcf.storedFileAt(2))
+        self.assertEqual(vcf.storedFileAt(3), os.path.join(self.dataDir, "ET3- test.tst"))
+        self.assertEqual(vcf.storedFileAt(4), os.path.join(self.dataDir, "ET3- test.tst"))
+
     def test_contentAtPreviousRevision_BT(self):
         """
         Checks that file can be restored at a previous revision (scenario of a commit of a text file over a binary file : BT)
@@ -1915,6 +2074,9 @@ class testVerConFile(unittest.TestCase):
         type,data = vcf.textOrBinary(os.path.join(self.rootDir, "test.txt"))
         self.assertEqual(type, "t")
         self.assertEqual(data, [self.t1])        
+        # without keeping binary data.
+        self.assertEqual(vcf.textOrBinary(os.path.join(self.rootDir, "test.bin"), keep_binary=False), ("b", None))
+        self.assertEqual(vcf.textOrBinary(os.path.join(self.rootDir, "test.txt"), keep_binary=False), ("t", [self.t1]))
             
     def test_createAtRevisionSubdir(self):
         """
@@ -1970,6 +2132,23 @@ class testVerConFile(unittest.TestCase):
         with self.assertRaises(VerConError):
             vcf.changeAtRevision(1)        
         
+    def test_changeAtRevisionUnchanged(self):
+        """
+        Ensures that no event (and no backup) is created when the file did not change since last revision.
+        """
+        logging.info("Running %s"%inspect.currentframe().f_code.co_name)
+        with open(os.path.join(self.rootDir, "test.txt"), "w", encoding="utf-8", newline="") as f:
+            f.write(self.t1)
+            
+        vcf = VerConFile("test.txt", self.rootDir, self.dataDir, "")
+        vcf.createAtRevision(1)
+        vcf.changeAtRevision(2)
+        
+        self.assertEqual(vcf.getLastRevision(), 1)
+        self.assertIsNone(vcf.getEventAtRevision(2))
+        self.assertTrue(vcf.isTouched())
+        self.assertFalse(os.path.isfile(os.path.join(self.dataDir, "BAK2- ET1- test.txt")))
+        
     def test_deleteAtRevision(self):
         """
         Ensures an exception is raised if no "create" event was recorded, or if the change event is
@@ -2025,6 +2204,91 @@ class testVerConFile(unittest.TestCase):
             self.assertEqual(vcf.mergeTextBackwards([1,2,3]),t["file1"], "Could not compute %s from %s with '%s' and '%s' as transform"%(t["file1"],t["file3"],t["delta3-2"], t["delta2-1"]))
 
 
+    def test_mergeTextBackwardsV2(self):
+        """
+        Ensures that deltas computed by calculateDelta (format v2) restore the previous revisions exactly,
+        including when the last line has no end of line, or uses \r\n.
+        """
+        logging.info("Running %s"%inspect.currentframe().f_code.co_name)
+        
+        datalist = [
+            {"file1": "baz\nfoo", "file2": "baz\nfoo\nbar", "file3": "foo\nbin\nbar"},
+            {"file1": "foo\nbar", "file2": "foo\nbaz\n", "file3": "foo\n"},
+            {"file1": "e", "file2": "\n\ne\n\n\n", "file3":"e\n\n"},
+            {"file1": "a\r\nb\r\nc", "file2": "a\r\nc\r\n", "file3": "z\r\na\r\nc"},
+            ]
+            
+        for t in datalist:
+            lines = {}
+            for k in t.keys():
+                lines[k] = io.StringIO(t[k], newline="").readlines()
+            
+            vcf = VerConFile("test", self.rootDir, self.dataDir, "")    
+            with open(os.path.join(self.dataDir, "HT1- test"), "w", encoding="utf-8", newline="") as f: 
+                f.write(vcf.calculateDelta(lines["file2"], lines["file1"]))
+            with open(os.path.join(self.dataDir, "HT2- test"), "w", encoding="utf-8", newline="") as f:
+                f.write(vcf.calculateDelta(lines["file3"], lines["file2"]))
+            with open(os.path.join(self.dataDir, "ET3- test"), "w", encoding="utf-8", newline="") as f:
+                f.write(t["file3"])
+
+            vcf.loadEvent("h",1,"t","HT1- test")
+            vcf.loadEvent("h",2,"t","HT2- test")
+            vcf.loadEvent("e",3,"t","ET3- test")
+            
+            self.assertEqual(vcf.mergeTextBackwards([2,3]),t["file2"])
+            self.assertEqual(vcf.mergeTextBackwards([1,2,3]),t["file1"])
+            
+        # a corrupted insert is detected.
+        with self.assertRaises(VerConError):
+            vcf.applyDeltaV2([], "VC2\ni 2 4\nfoo\n")
+        # so are malformed commands.
+        for deltas in ["VC2\ni 1\nfoo\n", "VC2\ni 1 x\nfoo\n", "VC2\nc\n", "VC2\nc1\n", "VC2\nx 1\n"]:
+            with self.assertRaises(VerConError):
+                vcf.applyDeltaV2(["a\n"], deltas)
+        self.assertEqual(vcf.applyDeltaV2(["a\n", "b\n"], "VC2\ns 1\nc 1\ni 1 4\nfoo\n"), ["b\n", "foo\n"])
+
+    def test_mergeTextBackwardsWideLines(self):
+        """
+        Ensures that files with very long lines (minified data) get small deltas, and are restored exactly.
+        """
+        logging.info("Running %s"%inspect.currentframe().f_code.co_name)
+        
+        items = ['"key%d": "value %d"'%(i, i) for i in range(200)]
+        file1 = "{" + ", ".join(items) + "}"
+        items[100] = '"key100": "changed"'
+        file2 = "header\n{" + ", ".join(items) + "}\n"
+        
+        vcf = VerConFile("test", self.rootDir, self.dataDir, "")
+        delta = vcf.calculateDelta([file2.split("\n")[0] + "\n", file2.split("\n")[1] + "\n"], [file1])
+        self.assertTrue(delta.startswith("VC2w\n"))
+        self.assertLess(len(delta), 200)
+        
+        with open(os.path.join(self.dataDir, "HT1- test"), "w", encoding="utf-8", newline="") as f: 
+            f.write(delta)
+        with open(os.path.join(self.dataDir, "ET2- test"), "w", encoding="utf-8", newline="") as f:
+            f.write(file2)
+        vcf.loadEvent("h",1,"t","HT1- test")
+        vcf.loadEvent("e",2,"t","ET2- test")
+        
+        self.assertEqual(vcf.mergeTextBackwards([1,2]), file1)
+        
+        # a chain of wide deltas: the units are cut back into lines between two deltas.
+        items[50] = '"key50": "changed too"'
+        file0 = "{" + ", ".join(items) + "}\nfooter\n"
+        vcf = VerConFile("test2", self.rootDir, self.dataDir, "")
+        with open(os.path.join(self.dataDir, "HT1- test2"), "w", encoding="utf-8", newline="") as f: 
+            f.write(vcf.calculateDelta([file1], [file0.split("\n")[0] + "\n", "footer\n"]))
+        with open(os.path.join(self.dataDir, "HT2- test2"), "w", encoding="utf-8", newline="") as f: 
+            f.write(delta)
+        with open(os.path.join(self.dataDir, "ET3- test2"), "w", encoding="utf-8", newline="") as f:
+            f.write(file2)
+        vcf.loadEvent("h",1,"t","HT1- test2")
+        vcf.loadEvent("h",2,"t","HT2- test2")
+        vcf.loadEvent("e",3,"t","ET3- test2")
+        
+        self.assertEqual(vcf.mergeTextBackwards([2,3]), file1)
+        self.assertEqual(vcf.mergeTextBackwards([1,2,3]), file0)
+
     def test_calculateDelta(self):
         """
         Ensures that delta is correctly generated.
@@ -2037,15 +2301,20 @@ class testVerConFile(unittest.TestCase):
         #self.assertEqual(vcf.calculateDelta("foo",""),"s 3")
 
         # warning: the order of arguments is from , to (not to, from !)
-        self.assertEqual(vcf.calculateDelta(["foo"],["bar"]),"s 1\ni 1\nbar\n")
-        self.assertEqual(vcf.calculateDelta(["foo\n","bar\n","baz"],["boo\n","bar\n","baz"]),"s 1\ni 1\nboo\nc 2\n")
-        self.assertEqual(vcf.calculateDelta([],["boo"]),"i 1\nboo\n")
-        self.assertEqual(vcf.calculateDelta(["foo"],[]),"s 1\n")
+        self.assertEqual(vcf.calculateDelta(["foo"],["bar"]),"VC2\ns 1\ni 1 3\nbar")
+        self.assertEqual(vcf.calculateDelta(["foo\n","bar\n","baz"],["boo\n","bar\n","baz"]),"VC2\ns 1\ni 1 4\nboo\nc 2\n")
+        self.assertEqual(vcf.calculateDelta([],["boo"]),"VC2\ni 1 3\nboo")
+        self.assertEqual(vcf.calculateDelta(["foo"],[]),"VC2\ns 1\n")
         # test from a problem with another test case
-        self.assertEqual(vcf.calculateDelta(["e"],["some text\n","extra text\n","\n"]), "s 1\ni 3\nsome text\nextra text\n\n")
+        self.assertEqual(vcf.calculateDelta(["e"],["some text\n","extra text\n","\n"]), "VC2\ns 1\ni 3 22\nsome text\nextra text\n\n")
         
         # what if we have many empty lines?
-        self.assertEqual(vcf.calculateDelta(["e"],["\n","\n","e\n","\n","\n"]), "s 1\ni 5\n\n\ne\n\n\n")
+        self.assertEqual(vcf.calculateDelta(["e"],["\n","\n","e\n","\n","\n"]), "VC2\ns 1\ni 5 6\n\n\ne\n\n\n")
+        
+        # and if one of the files is empty?
+        self.assertEqual(vcf.calculateDelta([],["a\n","b"]), "VC2\ni 2 3\na\nb")
+        self.assertEqual(vcf.calculateDelta(["a\n","b"],[]), "VC2\ns 2\n")
+        self.assertEqual(vcf.calculateDelta([],[]), "VC2\n")
 
     def test_isModified_FalseWhenNoModifications_DateSimilar_Text(self):
         """
@@ -2102,7 +2371,7 @@ class testVerConFile(unittest.TestCase):
         self.assertTrue(vcf.isModified())        
         
         
-    def test_isModified_TrueWhenModifications_DateSimilar_Text(self):
+    def test_isModified_TrueWhenModifications_DifferentDates_Text(self):
         """
         Ensures file comparison works in case the two files are different and do not have same metadata
         """
@@ -2325,7 +2594,7 @@ class testVerConFile(unittest.TestCase):
         self.assertTrue(vcf.isModified())        
         
         
-    def test_isModified_TrueWhenModifications_DateSimilar_Binary(self):
+    def test_isModified_TrueWhenModifications_DifferentDates_Binary(self):
         """
         Ensures file comparison works in case the two files are different and do not have same metadata
         """
@@ -2479,6 +2748,28 @@ class TestCase_SafetyMechanism(unittest.TestCase):
         # this should not crash
         vc.commit("Second commit")
 
+    def test_loadAfterCommitFailBeforeChange(self):
+        """
+        A commit fails right after a backup was made, while the data file is still there (the backup being
+        possibly a hard link to it): the file is kept as it was and the backup is removed.
+        """
+        logging.info("Running %s"%inspect.currentframe().f_code.co_name)
+        with open(os.path.join(self.tempDir.name, "test.bin"), "wb") as f:
+            f.write(self.datab)
+            
+        vc = VerConRepository(self.tempDir.name)
+        vc.commit("First commit")
+        
+        vc.lockRepository()
+        vc.getFileObject("", "test.bin").createBackup(2)
+        os.close(vc.lockfd)
+        
+        vc = VerConRepository(self.tempDir.name)
+        self.assertFalse(os.path.isfile(os.path.join(vc.getRepoDir(), "LOCK")))
+        self.assertFalse(os.path.isfile(os.path.join(vc.getDataDir(), "BAK2- EB1- test.bin")))
+        with open(os.path.join(vc.getDataDir(), "EB1- test.bin"), "rb") as f:
+            self.assertEqual(f.read(), self.datab)
+            
     def test_failAtFirstCommit(self):
         """
         What happens if there is a failure at first commit:
@@ -2531,6 +2822,153 @@ class TestCase_SafetyMechanism(unittest.TestCase):
         vc.commit("First commit")
         
 
+    def test_concurrentCommit(self):
+        """
+        A commit cannot start while the repository is locked by another commit,
+        and a LOCK held by a running commit is not mistaken for a crash.
+        """
+        logging.info("Running %s"%inspect.currentframe().f_code.co_name)
+        with open(os.path.join(self.tempDir.name, "test.txt"), "w", encoding="utf-8", newline="") as f:
+            f.write(self.datat)
+            
+        vc = VerConRepository(self.tempDir.name)
+        vc.commit("First commit")
+        
+        vc.lockRepository()
+        with self.assertRaises(VerConError):
+            VerConRepository(self.tempDir.name).lockRepository()
+            
+        # the advisory lock is only available on POSIX systems.
+        try:
+            import fcntl
+        except ImportError:
+            fcntl = None
+        if fcntl is not None:
+            with self.assertRaises(VerConError):
+                VerConRepository(self.tempDir.name)
+        
+        vc.unlockRepository()
+        self.assertFalse(os.path.isfile(os.path.join(self.repoDir, "LOCK")))
+        vc = VerConRepository(self.tempDir.name)
+        self.assertEqual(vc.getLastCommit(), 1)
+
+    def test_isDirtyRaces(self):
+        """
+        An empty LOCK that nobody holds is left by a crash: it is recovered as revision 0 (nothing to restore)
+        and removed, while a held LOCK means a commit is running. A LOCK removed by a commit that completes
+        while isDirty checks it is not recovered.
+        """
+        logging.info("Running %s"%inspect.currentframe().f_code.co_name)
+        with open(os.path.join(self.tempDir.name, "test.txt"), "w", encoding="utf-8", newline="") as f:
+            f.write(self.datat)
+            
+        vc = VerConRepository(self.tempDir.name)
+        vc.commit("First commit")
+        
+        with open(os.path.join(self.repoDir, "LOCK"), "w", encoding="utf-8", newline="") as f:
+            pass
+        self.assertEqual(vc.isDirty(), 0)
+        vc = VerConRepository(self.tempDir.name)
+        self.assertFalse(os.path.isfile(os.path.join(self.repoDir, "LOCK")))
+        self.assertEqual(vc.getLastCommit(), 1)
+        self.assertEqual(vc.isDirty(), -1)
+        
+        # the advisory lock is only available on POSIX systems.
+        try:
+            import fcntl
+        except ImportError:
+            fcntl = None
+        if fcntl is not None:
+            with open(os.path.join(self.repoDir, "LOCK"), "w", encoding="utf-8", newline="") as f:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                with self.assertRaises(VerConError):
+                    vc.isDirty()
+            os.unlink(os.path.join(self.repoDir, "LOCK"))
+            
+            holder = VerConRepository(self.tempDir.name)
+            holder.lockRepository()
+            self.assertEqual([n for n in os.listdir(self.repoDir) if n.startswith("LOCK")], ["LOCK"])
+            flock = fcntl.flock
+            def unlockThenFlock(fd, operation):
+                # the running commit completes between the opening of LOCK and its locking.
+                holder.unlockRepository()
+                flock(fd, operation)
+            with mock.patch("fcntl.flock", side_effect=unlockThenFlock):
+                self.assertEqual(vc.isDirty(), -1)
+            self.assertEqual([n for n in os.listdir(self.repoDir) if n.startswith("LOCK")], [])
+        
+        vc = VerConRepository(self.tempDir.name)
+        self.assertEqual(vc.getLastCommit(), 1)
+
+    def test_commitFromOutdatedObject(self):
+        """
+        A repository object loaded before another one committed does not commit the same revision again:
+        the last commit is read again once the repository is locked.
+        """
+        logging.info("Running %s"%inspect.currentframe().f_code.co_name)
+        with open(os.path.join(self.tempDir.name, "test.txt"), "w", encoding="utf-8", newline="") as f:
+            f.write(self.datat)
+            
+        vc = VerConRepository(self.tempDir.name)
+        vc.commit("First commit")
+        self.assertEqual(vc.readLastCommit(), 1)
+        
+        outdated = VerConRepository(self.tempDir.name)
+        with open(os.path.join(self.tempDir.name, "test.txt"), "a", encoding="utf-8", newline="") as f:
+            f.write("more text\n")
+        # a long comment, the beginning of the last entry is not in the first block read.
+        vc.commit("Second commit " + "x"*100000)
+        self.assertEqual(vc.readLastCommit(), 2)
+        
+        with open(os.path.join(self.tempDir.name, "test2.txt"), "w", encoding="utf-8", newline="") as f:
+            f.write(self.datat)
+        with self.assertRaises(VerConError):
+            outdated.commit("Outdated commit")
+        self.assertFalse(os.path.isfile(os.path.join(self.repoDir, "LOCK")))
+        with open(os.path.join(self.repoDir, "commits.txt"), "r", encoding="utf-8", newline="") as f:
+            self.assertEqual([l for l in f.read().split("\n") if l.startswith("2. ")], ["2. Second commit " + "x"*100000])
+        
+        vc = VerConRepository(self.tempDir.name)
+        self.assertEqual(vc.getLastCommit(), 2)
+        vc.commit("Third commit")
+        self.assertEqual(vc.getLastCommit(), 3)
+        self.assertEqual(vc.readLastCommit(), 3)
+
+    def test_syncToDisk(self):
+        """
+        The data files written during a commit are collected once and synced at the end of the commit,
+        a file renamed in the meantime does not make the sync fail.
+        """
+        logging.info("Running %s"%inspect.currentframe().f_code.co_name)
+        with open(os.path.join(self.tempDir.name, "test.txt"), "w", encoding="utf-8", newline="") as f:
+            f.write(self.datat)
+            
+        vc = VerConRepository(self.tempDir.name)
+        vc.commit("First commit")
+        self.assertEqual(vc.getFileObject("", "test.txt").written, [])
+        
+        with open(os.path.join(self.tempDir.name, "test.txt"), "a", encoding="utf-8", newline="") as f:
+            f.write("more text\n")
+        # the files and directories synced are known by their inodes.
+        synced = set()
+        fsync = os.fsync
+        def recordFsync(fd):
+            synced.add(os.fstat(fd).st_ino)
+            fsync(fd)
+        with mock.patch("os.fsync", side_effect=recordFsync) as m:
+            vc.commit("Second commit")
+        self.assertEqual(vc.getFileObject("", "test.txt").written, [])
+        
+        # the new data file and the history file, then their directory, the metadata and its directory.
+        for p in (os.path.join(self.repoDir, "DATA", "ET2- test.txt"), os.path.join(self.repoDir, "DATA", "HT1- test.txt"),
+                  os.path.join(self.repoDir, "DATA"), os.path.join(self.repoDir, "metadatadir.txt"),
+                  os.path.join(self.repoDir, "commits.txt"), self.repoDir):
+            self.assertIn(os.stat(p).st_ino, synced, p)
+        # each of them is synced once, and the LOCK is synced when it is created.
+        self.assertEqual(m.call_count, 7)
+        
+        vc.syncToDisk([os.path.join(self.repoDir, "DATA", "ET1- test.txt"), os.path.join(self.repoDir, "DATA", "ET2- test.txt")])
+
     def test_cleanup(self):
         """
         Tests if the cleanup function (called after a successful commit) really removes the BAK files of the previous commits.
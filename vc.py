@@ -49,10 +49,15 @@ stores:
     * copy of the last version of the file preceded by ET<rev>- (latest revision) or D<rev>- (if deleted, file empty)
     * a list of deltas (+/- lines) in reverse order to reconstruct previous revisions, same file name with HT<rev>- for each delta.
       This information is stored as a series of 5-uples inspired by that in SequenceMatcher (cf https://docs.python.org/3/library/difflib.html?highlight=diff#difflib.SequenceMatcher)
-      i count\n                                    (insert count characters in the new file)
-      <count characters, possibly including\ns...>\n
-      s count\n                                      (skip the next count characters of the old file)
-      c count\n                                      (copy the next count to new file)
+      VC2\n                                        (header of the format, version 2)
+      i count length\n                             (insert count lines in the new file)
+      <length characters, the inserted lines as-is, no separator added>
+      s count\n                                      (skip the next count lines of the old file)
+      c count\n                                      (copy the next count lines to new file)
+      If the files have lines longer than WIDE_LINE, the header is VC2w and the counts are in units (long lines being cut
+      after spaces and punctuation) instead of lines.
+      Deltas without the VC2 header use the previous format (v1), where the inserted lines follow "i count\n"
+      one per line, with a \n added to the last one if it had none. They can still be read.
   - binary file, every time the file changes a new copy is stored.
     * latest version preceded with EB<rev>- (latest revision) or D<rev>- (if deleted, file empty)
     * copies preceded with HB<rev>-
@@ -145,10 +150,16 @@ Stages of safety mechanism (B1)
 -------------------------------
 
 Before commit:
-- create "lock%d" file in REPO
+- create "lock%d" file in REPO (exclusively ; on POSIX systems it is also kept locked with flock until the end of the commit,
+  so that another process finding it knows whether the commit is still running or has crashed)
 
 During commit:
-- every time a file is edited, first make a copy to BAK%d-<filename>.
+- every time a file is edited, first make a copy to BAK%d-<filename> (a hard link for data files, as they are never
+  rewritten in place).
+
+During commit:
+- metadatadir.txt is written to metadatadir.txt.new, then renamed over metadatadir.txt.
+- the data files are synced to disk all together before the metadata is written, and the metadata before the lock is removed.
 
 After commit:
 1. delete lock%d
@@ -186,7 +197,7 @@ TODO/BUGS:
 - code refactoring
 - proper project documentation
 - more testing!
-- BUG? : spurious final new line may be inserted to restored files when original may not have had one (good luck...).
+- SOLVED (delta format v2): spurious final new line may be inserted to restored files when original may not have had one (good luck...).
 - BUG : when displaying commit log, extra end of lines are added at the end of the display.
 
 
@@ -198,18 +209,54 @@ TODO/BUGS:
 
 """
 
-import os,sys,re,difflib,shutil,filecmp,logging,time
+import os,sys,re,difflib,shutil,logging,time,bisect,io,threading,itertools,tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+# advisory locks are only available on POSIX systems; elsewhere the LOCK file alone is used.
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 # ugly but works
 logger = logging.getLogger("VerConRepository")
 
+# first line of a delta file stored in format v2 (see calculateDelta)
+DELTA_HEADER = "VC2\n"
+# same, when the delta was computed on wide lines split into smaller units (see splitWideLines)
+DELTA_HEADER_WIDE = "VC2w\n"
+# lines longer than this are split into units for diffing (minified files, long paragraphs...)
+WIDE_LINE = 256
+WIDE_LINE_RE = re.compile(r"[^ ,;>}\]]*[ ,;>}\]]+|.+", re.S)
+# size of the blocks read when comparing the contents of two files
+COMPARE_BLOCK = 1<<20
+# the two buffers of COMPARE_BLOCK bytes used by isModified, allocated once per thread (see compareBuffers)
+COMPARE_BUFFERS = threading.local()
+# the name of a data file: D (deletion) or event E, H and type B, T, then revision, file name
+EVENT_RE = re.compile(r"^(?:(D)|([EH])([BT]))(\d+)- (.+)$", re.I)
+# a detail line of commits.txt (a file or directory added, modified or deleted), dropped by a non-verbose list
+LOG_DETAIL_RE = re.compile(r"^  [^\n]*\n?", re.M)
+# the first line of an entry of commits.txt: revision and comment (see readLastCommit)
+LOG_HEADER_RE = re.compile(r"(?:\A|\n\n)(\d+)\. ")
+# the name of a data file that can have a backup: E or D event, revision, file name (see recover)
+STORED_RE = re.compile(r"^(?:EB|ET|D)(\d+)- (.*)")
+# the name of any backup file, with the revision of the commit it was made for (see cleanup)
+BACKUP_RE = re.compile(r"^BAK(\d+)-")
+# a command line of a delta file in format v1
+DELTA_V1_RE = re.compile(r"(^[isc]) (\d+)$")
+
 class VerConError(Exception):
     pass
     
 class VerConEvent():
     """
     It's really just a data structure to help VerConFile.
+    
+    There is one instance per file and per revision, so the attributes are declared in __slots__
+    to avoid a dictionnary per instance.
     """
+    __slots__ = ("event", "type", "fname")
+    
     def __init__(self, event, type, fname):
         self.event = event
         self.type = type
@@ -234,6 +281,82 @@ class VerConEvent():
         """
         return "(event: %s, type: %s, file name: %s)"%(self.event, self.type, self.fname)
     
+def compareBuffers():
+    """
+    Returns the two bytearrays of COMPARE_BLOCK bytes used by isModified to compare file contents.
+    
+    They are allocated on the first call in each thread and kept in COMPARE_BUFFERS, so that comparing the
+    many files of a commit does not allocate two new blocks for every read. A buffer cannot be shared between
+    threads since commitDirectories compares files in a thread pool.
+    """
+    buffers = getattr(COMPARE_BUFFERS, "buffers", None)
+    if buffers is None:
+        buffers = (bytearray(COMPARE_BLOCK), bytearray(COMPARE_BLOCK))
+        COMPARE_BUFFERS.buffers = buffers
+    return buffers
+
+def walkUserTree(baseDir, relPath, skipMissing=False):
+    """
+    Walks the tree of the user space under baseDir, like os.walk, with a stack instead of recursive calls.
+    
+    baseDir: the absolute path of the directory to walk
+    relPath: its path relative to the root of the user space
+    skipMissing: if True, a directory removed before it is read is left out and the walk goes on with the others,
+    otherwise FileNotFoundError is raised
+    
+    Yields, for each directory, a tuple (absolute path, relative path, list of os.DirEntry of its contents).
+    Directories named REPO are left out of the lists and are not walked into. The subdirectories of a directory
+    are only read once the caller asks for the next tuple, so that the caller can process them first.
+    """
+    stack = [(baseDir, relPath)]
+    while len(stack) > 0:
+        baseDir, relPath = stack.pop()
+        try:
+            with os.scandir(baseDir) as it:
+                entries = [item for item in it if not (item.name == "REPO" and item.is_dir())]
+        except FileNotFoundError:
+            if not skipMissing:
+                raise
+            logger.debug("walkUserTree: It seems that %s is not present in user space, skipping."%baseDir)
+            continue
+        yield (baseDir, relPath, entries)
+        # reversed, so that the first subdirectory is the next one walked. The relative paths are built
+        # by concatenation: relPath is already a clean relative path and a name is a single component.
+        prefix = relPath + os.sep if relPath != "" else ""
+        for item in reversed(entries):
+            if item.is_dir():
+                stack.append((item.path, prefix + item.name))
+
+def fsyncPath(path, isDir=False):
+    """
+    Flushes the file (or the directory if isDir is True) at path to disk.
+    
+    A file that is not there any more is skipped, as well as a directory that cannot be opened or synced
+    (directories cannot be opened on some systems, like Windows).
+    """
+    if isDir:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+        return
+        
+    try:
+        # Windows only flushes files opened for writing.
+        fd = os.open(path, os.O_RDWR if os.name == "nt" else os.O_RDONLY)
+    except FileNotFoundError:
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
 class VerConFile():
     """
     A helper class representing a file in the repository.
@@ -246,7 +369,11 @@ class VerConFile():
     - to randomly add events to the file (because directory traversal is not always ordered)
     - to compute the delta for two successive revisions
     - to get data information for a given revision.
+    
+    There is one instance per file of the repository, the attributes are declared in __slots__.
     """
+    __slots__ = ("name", "rootp", "datap", "frelp", "_dataprefix", "_userprefix", "events", "_sorted_revs",
+                 "hasE", "lastrevision", "touched", "written")
     
     def __init__(self, name, rootdirectorypath, datadirectorypath, filerelpath):
         """
@@ -261,7 +388,10 @@ class VerConFile():
         precise location of user file can be computed by joining rootdirectorypath + filerelpath
         
         self.events contains a dictionnary of events, with the key being the revision number. Each event entry is a VerConEvent object (really just a data structure).
+        self._sorted_revs contains the keys of self.events in increasing order, kept up to date by loadEvent, so that lookups by revision can use bisect.
         self.hasE contains a revision number if an E event has been found, -1 otherwise.
+        self.written contains the data files written or renamed during the current commit, so that they are synced to disk
+        all at once at the end of the commit (see VerConRepository.syncToDisk).
         """
         
         self.name = name
@@ -269,10 +399,16 @@ class VerConFile():
         self.datap = datadirectorypath
         self.frelp = filerelpath
         
+        # directories of the data files and of the user file, with a trailing separator, to build paths by concatenation.
+        self._dataprefix = os.path.join(self.datap, self.frelp, "")
+        self._userprefix = os.path.join(self.rootp, self.frelp, "")
+        
         self.events = {}
+        self._sorted_revs = []
         self.hasE = -1
         self.lastrevision = -1
         self.touched = False
+        self.written = []
         
     def __repr__(self):
         """
@@ -303,12 +439,13 @@ class VerConFile():
         
         Raises VerConError if there was no such event.
         """
-        if len(self.events) == 0:
+        if not self.events:
             raise VerConError("This file %s has never been commited!"%self.name)
             
-        logger.debug("Last event of file %s is at path %s"%(self.name, os.path.join(self.datap, self.frelp, self.events[self.lastrevision].fname)))
+        path = self._dataprefix + self.events[self.lastrevision].fname
+        logger.debug("Last event of file %s is at path %s"%(self.name, path))
         
-        return os.path.join(self.datap, self.frelp, self.events[self.lastrevision].fname)
+        return path
         
     def getLastRevision(self):
         """
@@ -340,7 +477,7 @@ class VerConFile():
         if ftype not in ["t", "b"]:
             raise VerConError("Invalid file type: %s"%ftype)
         
-        if revision in self.events.keys():
+        if revision in self.events:
             raise VerConError("An event is already registered at this revision: %d"%revision)
         
         if event == "e" and self.hasE != -1:
@@ -350,6 +487,7 @@ class VerConFile():
             raise VerConError("A %s event is being added at revision %d, after a E event which should be final at revision %d"%(event, revision, self.hasE))
             
         self.events[revision] = VerConEvent(event,ftype,fname)
+        bisect.insort(self._sorted_revs, revision)
         if event == "e":
             self.hasE = revision
             
@@ -361,7 +499,7 @@ class VerConFile():
         """
         Returns true if the file item has never been committed (0 element in history)
         """
-        return len(self.events.keys()) == 0
+        return not self.events
         
     def existsAt(self, revision):
         """
@@ -369,19 +507,13 @@ class VerConFile():
         
         We expect the event dictionnary to faithfully represent the file's change of states.
         
+        The last event at or before revision is located by bisection in self._sorted_revs.
         """
-       
-        active = False
-        for i in sorted(self.events.keys()):
-            if i > revision:
-                return active
-            else:
-                if self.events[i].event in ["e","h"]:
-                    active = True
-                else: # case of a deletion event
-                    active = False
+        idx = bisect.bisect_right(self._sorted_revs, revision)
+        if idx == 0:
+            return False
         
-        return active
+        return self.events[self._sorted_revs[idx-1]].event in ["e","h"]
         
         
     def fTypeAt(self, revision):
@@ -392,15 +524,15 @@ class VerConFile():
         
         Not using a boolean function here because in the future maybe there can be different test files, to implement diffs for other text file formats.
         """
-        type = ""
-        for i in sorted(self.events.keys()):
-            if i > revision:
-                return type
-            else:
-                if self.events[i].event in ["e","h"]:
-                    type = self.events[i].type
+        idx = bisect.bisect_right(self._sorted_revs, revision)
+        # deletion events do not carry a type, we go back to the last e or h event.
+        while idx > 0:
+            idx -= 1
+            event = self.events[self._sorted_revs[idx]]
+            if event.event in ["e","h"]:
+                return event.type
         
-        return type
+        return ""
         
     def contentsAt(self, revision):
         """
@@ -417,111 +549,189 @@ class VerConFile():
           * if we find a ET: we then generate the file backwards with the diffs.
           * anything else: we open the previous element found (including the HT if exists) as a standard text file, and we diff with the previous ones back to the first (if not already used, if remain).
         """
-        objective = -1
         data = None
-        klist = list(self.events.keys())
-        klist.sort(reverse=True)
+        revs = self._sorted_revs
         
-        for i in klist:
-            if i <= revision:
-                objective = i
-                break
+        begin = bisect.bisect_right(revs, revision) - 1
                 
-        if objective == -1:
+        if begin == -1:
             raise VerConError("Trying to return contents of a file that was not added yet to the repository at this revision %d"%revision)
+        
+        objective = revs[begin]
+        event = self.events[objective]
             
-        if self.events[objective].event == "d":
+        if event.event == "d":
             raise VerConError("Trying to return contents of a file which is deleted in tree at this revision %d"%revision)
             
         # the event is the last event, it's easy enough then.
-        if self.events[objective].event == "e":
+        if event.event == "e":
             rtype = "r"
-            if self.events[objective].type == "t":
-                with open(os.path.join(self.datap, self.frelp, self.events[objective].fname),"r", encoding="utf-8", newline='') as f:
+            if event.type == "t":
+                with open(self._dataprefix + event.fname,"r", encoding="utf-8", newline='') as f:
                     data = f.read()
             else:
-                with open(os.path.join(self.datap, self.frelp, self.events[objective].fname),"rb") as f:
+                with open(self._dataprefix + event.fname,"rb") as f:
                     data = f.read()
 
-        elif self.events[objective].event == "h":
+        elif event.event == "h":
             # we have a history of a binary file, we just restore it as is.
-            if self.events[objective].type == "b":
-                with open(os.path.join(self.datap, self.frelp, self.events[objective].fname),"rb") as f:
+            if event.type == "b":
+                with open(self._dataprefix + event.fname,"rb") as f:
                     data = f.read()        
                     
             else:
                 # final case , we are at the history of a text file (HT)
-                klist.reverse()
-                begin = klist.index(objective)
-                for i in klist[begin:]:
+                end = len(revs)
+                for i in range(begin, len(revs)):
+                    event = self.events[revs[i]]
                     # case for the last event
-                    if self.events[i].event == "e":
-                        end = klist.index(i)
+                    if event.event == "e":
+                        end = i
                         # if it is text, we need to take it into account, otherwise we will start at event -1.
-                        if self.events[i].type == "t":
+                        if event.type == "t":
                             end += 1
                         break
                     # case for a deletion
-                    elif self.events[i].event == "d":
-                        end = klist.index(i)
+                    elif event.event == "d":
+                        end = i
                         break
                     else:
                         # case for a HB
-                        if self.events[i].type == "b":
-                            end = klist.index(i)
+                        if event.type == "b":
+                            end = i
                             break
                         
                         # if we have a HT? we just continue.
-                if end >= len(klist):
-                    data = self.mergeTextBackwards(klist[begin:])
-                else:
-                    data = self.mergeTextBackwards(klist[begin:end])
+                data = self.mergeTextBackwards(revs[begin:end])
 
         return data
+        
+    def storedFileAt(self, revision):
+        """
+        Returns the path of the data file holding the contents of the file at the given revision as-is (an E file,
+        or the HB file of a binary revision), or None if the contents have to be computed (text history) or the file
+        does not exist at this revision.
+        
+        A stored file can be copied as it is to restore the file, without loading it in memory (see restoreTo).
+        """
+        idx = bisect.bisect_right(self._sorted_revs, revision) - 1
+        if idx == -1:
+            return None
+        event = self.events[self._sorted_revs[idx]]
+        if event.event == "e" or (event.event == "h" and event.type == "b"):
+            return self._dataprefix + event.fname
+        return None
+    
+    def restoreAt(self, revision, path):
+        """
+        Writes the contents of the file at the given revision to path.
+        
+        The contents stored as-is are copied by the kernel (where possible), never loaded in memory. The other
+        existing revisions are text history (HT), computed by contentsAt: there is no need to look up the type.
+        """
+        stored = self.storedFileAt(revision)
+        if stored is not None:
+            shutil.copyfile(stored, path)
+        else:
+            with open(path, "w", encoding="utf-8", newline='') as out:
+                out.write(self.contentsAt(revision))
     
     def calculateDelta(self, fromX, toY):
         """
         This function takes two text files (loaded as lists of \n-terminated strings) and returns the delta to go from the first to the second.
         
-        KNOWN BUG: will add an extra \n to a file where the last element is to be inserted without \n.
+        The delta is written in format v2 (see mergeTextBackwards): inserted lines are stored as-is, prefixed by their
+        total length, so that a last line without \n is restored faithfully.
+        
+        If one of the files has lines wider than WIDE_LINE (minified JSON, HTML...), the delta is computed on the units
+        given by splitWideLines instead of lines, and its header is DELTA_HEADER_WIDE. A change in a long line then only
+        stores the units around the change instead of the whole line.
         """
+        out = io.StringIO(newline='')
+        self.calculateDeltaStream(fromX, toY, out)
+        return out.getvalue()
         
-        differ = difflib.SequenceMatcher(isjunk=None, a=fromX, b=toY, autojunk=True)
-        res = differ.get_opcodes()
+    def calculateDeltaStream(self, fromX, toY, out):
+        """
+        Same as calculateDelta, but the delta is written piece by piece to out (a text stream,
+        such as a file opened with newline=''), so that it never exists as a whole in memory.
         
-        logger.debug("calculateDelta: Got the following opcodes: %s"%res)
+        When one of the files is empty the delta is known beforehand (skip everything, or insert everything),
+        it is then written directly without scanning nor diffing the lines.
+        """
+        if len(fromX) == 0 or len(toY) == 0:
+            out.write(DELTA_HEADER)
+            if len(fromX) > 0:
+                out.write("s %d\n"%len(fromX))
+            if len(toY) > 0:
+                payload = "".join(toY)
+                out.write("i %d %d\n"%(len(toY), len(payload)))
+                out.write(payload)
+            return
+            
+        header = DELTA_HEADER
+        for line in itertools.chain(fromX, toY):
+            if len(line) > WIDE_LINE:
+                header = DELTA_HEADER_WIDE
+                fromX = self.splitWideLines(fromX)
+                toY = self.splitWideLines(toY)
+                break
         
-        outcodes = []
-        for tag, i1, i2, j1, j2 in res:
-            if tag == "delete":
-                outcodes.append(("s", i2-i1, None))
-            elif tag == "equal":
-                outcodes.append(("c", i2-i1, None))
-            elif tag == "insert":
-                outcodes.append(("i", j2-j1, toY[j1:j2]))
-            elif tag == "replace":
-                outcodes.append(("s", i2-i1, None))
-                outcodes.append(("i", j2-j1, toY[j1:j2]))
+        # the lines common to the beginning and to the end of both files are copied as-is, only the
+        # middle part goes through SequenceMatcher (most commits only change a few lines of a file).
+        lena = len(fromX)
+        lenb = len(toY)
+        prefix = 0
+        while prefix < lena and prefix < lenb and fromX[prefix] == toY[prefix]:
+            prefix += 1
+        suffix = 0
+        while suffix < lena - prefix and suffix < lenb - prefix and fromX[lena-1-suffix] == toY[lenb-1-suffix]:
+            suffix += 1
+        
+        differ = difflib.SequenceMatcher(isjunk=None, a=fromX[prefix:lena-suffix], b=toY[prefix:lenb-suffix], autojunk=True)
+        
+        matching = differ.get_matching_blocks()
+        logger.debug("calculateDeltaStream: Got %d matching blocks after a common prefix of %d and before a common suffix of %d"%(len(matching), prefix, suffix))
+        
+        # the blocks are shifted by the prefix as they are used, the common prefix and suffix being blocks too.
+        blocks = itertools.chain([(0, 0, prefix)], ((i + prefix, j + prefix, size) for i, j, size in matching), [(lena - suffix, lenb - suffix, suffix)])
+        
+        # single pass over the matching blocks: what lies between two blocks is skipped in fromX
+        # and inserted from toY, then the block itself is copied. Contiguous blocks are copied at once.
+        out.write(header)
+        previ = 0
+        prevj = 0
+        copy = 0
+        for i, j, size in blocks:
+            if i > previ or j > prevj:
+                if copy > 0:
+                    out.write("c %d\n"%copy)
+                    copy = 0
+                if i > previ:
+                    out.write("s %d\n"%(i - previ))
+                if j > prevj:
+                    payload = "".join(toY[prevj:j])
+                    out.write("i %d %d\n"%(j - prevj, len(payload)))
+                    out.write(payload)
+            copy += size
+            previ = i + size
+            prevj = j + size
+        if copy > 0:
+            out.write("c %d\n"%copy)
+    
+    def splitWideLines(self, lines):
+        """
+        Returns a new list where the lines longer than WIDE_LINE are split after each space, comma, semicolon, >, } or ],
+        the other lines being kept as they are. Joining the result gives back exactly the same text.
+        """
+        units = []
+        for line in lines:
+            if len(line) > WIDE_LINE:
+                units.extend(WIDE_LINE_RE.findall(line))
             else:
-                raise VerConError("This should not happen.")
-        
-        soutcodes = []
+                units.append(line)
+        return units
         
-        for type, count, st in outcodes:
-            if st != None:
-                soutcodes.append("%s %d\n"%(type, count))
-                for stuff in st:
-                    if not stuff.endswith("\n"):
-                        soutcodes.append("%s\n"%stuff)
-                    else:
-                        soutcodes.append(stuff)
-            else:
-                soutcodes.append("%s %d\n"%(type, count))
-                
-        logger.debug("calculateDelta: Computed the following opcodes: %r"%soutcodes)
-                
-        return "".join(soutcodes)
-    
     def mergeTextBackwards(self, revList):
         """
         This function returns the "merging" of successive revisions of
@@ -535,64 +745,177 @@ class VerConFile():
         
         It returns the data corresponding to the file at the earlier point in time.
         
-        Delta file format:
+        Delta file format (v2):
         
         This information is stored as a series of 5-uples inspired by that in SequenceMatcher (cf https://docs.python.org/3/library/difflib.html?highlight=diff#difflib.SequenceMatcher)
-          i count\n                                    (insert count characters in the new file)
-          <count characters, possibly including\ns...>\n
-          s count\n                                      (skip the next count characters of the old file)
-          c count\n                                      (copy the next count to new file)
+          VC2\n                                        (header)
+          i count length\n                             (insert count lines in the new file)
+          <length characters, possibly including\ns...>
+          s count\n                                      (skip the next count lines of the old file)
+          c count\n                                      (copy the next count lines to new file)
+          
+        Files without the header are in format v1 and are handled by applyDeltaV1.
         """
         data = ""
         
         final = self.events[revList.pop()] # get the last event index
         
-        with open(os.path.join(self.datap,self.frelp,final.fname), "r", encoding="utf-8", newline='') as f:
+        with open(self._dataprefix + final.fname, "r", encoding="utf-8", newline='') as f:
             data = f.readlines()
             
         logger.debug("mergeTextBackwards: We have %s as data"%data)
             
         revList.reverse()
-        matcher = re.compile("(^[isc]) (\d+)$")
-        for i in revList:
-            with open(os.path.join(self.datap,self.frelp,self.events[i].fname), "r", encoding="utf-8", newline='') as f:
-                deltas = f.readlines()      
-                
-                logger.debug("mergeTextBackwards: We have %s as deltas for revision %d"%(deltas, i))
-                newdata = []
-                indexdelta = 0
-                indexdata = 0
-                while indexdelta < len(deltas):
-                    command = matcher.match(deltas[indexdelta])
-                    if command == None:
-                        raise VerConError("data %s does not start with a valid command."%deltas[indexdelta:])
-                    
-                    indexdelta += 1 # we need to add 1 extra lines for the hidden \n at the end of each line.
-                    action = command.group(1)
-                    count = int(command.group(2))
-                    
-                    # skip action: we skip X lines of old data.
-                    if action == "s":
-                        indexdata += count
-                    # copy action: we copy X lines of old data to new data.
-                    elif action == "c":
-                        newdata.extend(data[indexdata:indexdata+count])
-                        indexdata += count
-                    # insert action: we insert X lines from deltas, to new data.
-                    elif action == "i":
-                        newdata.extend(deltas[indexdelta:indexdelta+count])
-                        indexdelta += count
-                    else:
-                        raise VerConError("invalid action %s"%action)
-                        
-                # once we are here, we can assemble the bits and form the "new" file...
-                data = newdata
+        last = revList[-1] if len(revList) > 0 else None
+        # all the deltas are read in one go before being applied.
+        for i, deltas in zip(revList, self.readDeltas(revList)):
+            logger.debug("mergeTextBackwards: We have %r as deltas for revision %d"%(deltas, i))
+            
+            if deltas.startswith(DELTA_HEADER):
+                data = self.applyDeltaV2(data, deltas)
+            elif deltas.startswith(DELTA_HEADER_WIDE):
+                data = self.applyDeltaV2(self.splitWideLines(data), deltas)
+                # the delta works on units, the result is cut back into lines for the next delta. After the last
+                # one, the units are joined as they are.
+                if i != last:
+                    data = io.StringIO("".join(data), newline='').readlines()
+            else:
+                data = self.applyDeltaV1(data, io.StringIO(deltas, newline='').readlines())
                 
-                logger.debug("mergeTextBackwards: at revision %d we have now data %s"%(i-1, data))
+            logger.debug("mergeTextBackwards: at revision %d we have now data %s"%(i-1, data))
                     
         return "".join(data)
         
-    def textOrBinary(self, path):
+    def readDeltas(self, revList):
+        """
+        Reads the delta files of the revisions in revList, and returns their contents (str) in the same order.
+        
+        Each file is read whole with a single low level read, after telling the OS that it will be read
+        sequentially (where supported). No newline translation is done, like open(..., newline='').
+        """
+        deltas = []
+        for i in revList:
+            fd = os.open(self._dataprefix + self.events[i].fname, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+            try:
+                if hasattr(os, "posix_fadvise"):
+                    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                size = os.fstat(fd).st_size
+                chunks = []
+                while True:
+                    chunk = os.read(fd, max(size, 4096))
+                    if not chunk:
+                        break
+                    chunks.append(chunk)
+            finally:
+                os.close(fd)
+            deltas.append(b"".join(chunks).decode("utf-8"))
+            
+        return deltas
+        
+    def applyDeltaV2(self, data, deltas):
+        """
+        Applies a delta in format v2 (a string, header included) to data (a list of lines), and
+        returns the resulting list of lines.
+        
+        The delta is walked with a cursor: each command is read up to its \n, its numbers being converted
+        from slices of the delta (no regexp, no split), and the payload of an insertion is taken as a whole
+        thanks to its length.
+        
+        For a delta with DELTA_HEADER_WIDE, data must be split with splitWideLines, and the inserted
+        units are returned as a single element: only the joined result is meaningful.
+        """
+        newdata = []
+        indexdata = 0
+        wide = deltas.startswith(DELTA_HEADER_WIDE)
+        cursor = deltas.index("\n") + 1
+        end = len(deltas)
+        while cursor < end:
+            eol = deltas.find("\n", cursor)
+            if eol == -1:
+                eol = end
+            # the command is a single character followed by its numbers, which are read in place.
+            action = deltas[cursor]
+            sep = deltas.find(" ", cursor + 2, eol) if action == "i" else -1
+            try:
+                if deltas[cursor+1] != " ":
+                    raise ValueError
+                count = int(deltas[cursor+2:eol if sep == -1 else sep])
+            except (IndexError, ValueError):
+                raise VerConError("data %r does not start with a valid command."%deltas[cursor:])
+            start = cursor
+            cursor = eol + 1
+            
+            # skip action: we skip X lines of old data.
+            if action == "s":
+                indexdata += count
+            # copy action: we copy X lines of old data to new data.
+            elif action == "c":
+                newdata.extend(data[indexdata:indexdata+count])
+                indexdata += count
+            # insert action: we insert X lines, stored as a block of known length, to new data.
+            elif action == "i":
+                try:
+                    if sep == -1:
+                        raise ValueError
+                    length = int(deltas[sep+1:eol])
+                except ValueError:
+                    raise VerConError("insert command %r has no valid length."%deltas[start:eol])
+                if wide:
+                    newdata.append(deltas[cursor:cursor+length])
+                    cursor += length
+                    continue
+                lines = io.StringIO(deltas[cursor:cursor+length], newline='').readlines()
+                if len(lines) != count:
+                    raise VerConError("insert command expected %d lines, found %d."%(count, len(lines)))
+                newdata.extend(lines)
+                cursor += length
+            else:
+                raise VerConError("invalid action %s"%action)
+                
+        return newdata
+        
+    def applyDeltaV1(self, data, deltas):
+        """
+        Applies a delta in format v1 (list of lines, without header) to data (a list of lines), and
+        returns the resulting list of lines.
+        
+        Kept so that repositories created before format v2 can still be read.
+        
+          i count\n                                    (insert count lines in the new file)
+          <count lines, one per line, the last one followed by \n>
+          s count\n                                      (skip the next count lines of the old file)
+          c count\n                                      (copy the next count lines to new file)
+        """
+        match = DELTA_V1_RE.match
+        newdata = []
+        indexdelta = 0
+        indexdata = 0
+        while indexdelta < len(deltas):
+            command = match(deltas[indexdelta])
+            if command is None:
+                raise VerConError("data %s does not start with a valid command."%deltas[indexdelta:])
+            
+            indexdelta += 1 # we need to add 1 extra lines for the hidden \n at the end of each line.
+            action = command.group(1)
+            count = int(command.group(2))
+            
+            # skip action: we skip X lines of old data.
+            if action == "s":
+                indexdata += count
+            # copy action: we copy X lines of old data to new data.
+            elif action == "c":
+                newdata.extend(data[indexdata:indexdata+count])
+                indexdata += count
+            # insert action: we insert X lines from deltas, to new data.
+            elif action == "i":
+                newdata.extend(deltas[indexdelta:indexdelta+count])
+                indexdelta += count
+            else:
+                raise VerConError("invalid action %s"%action)
+                
+        return newdata
+        
+    def textOrBinary(self, path, probe_only=False, keep_binary=True):
         """
         A helper function that will return a 2-uple containg "t"/"b" + data either as a list of strings (text file)
         or as a binary line.
@@ -600,20 +923,56 @@ class VerConFile():
         File must exist, otherwise...
         
         Added universal new lines.
+        
+        If probe_only is True, data is None: the file is only decoded chunk by chunk to find its type, and
+        nothing is kept in memory (for callers that copy the file as-is).
+        
+        If keep_binary is False, data is None for a binary file: the file is decoded chunk by chunk, and the
+        reading stops at the first chunk that is not valid UTF-8 (for callers that only need the lines of
+        text files, binary files being copied as-is).
         """
         data = None
         type = None
-        try:
-            with open(path, 'r', encoding='utf-8',newline='') as f:
-                data = f.readlines()
+        if probe_only or not keep_binary:
+            chunks = []
+            try:
+                with open(path, 'r', encoding='utf-8',newline='') as f:
+                    while True:
+                        chunk = f.read(1<<16)
+                        if chunk == "":
+                            break
+                        if not probe_only:
+                            chunks.append(chunk)
                 type = "t"
+            except UnicodeDecodeError:
+                return ("b", None)
+            if not probe_only:
+                data = io.StringIO("".join(chunks), newline='').readlines()
+            return (type, data)
+            
+        # the file is read once as bytes, and decoded in one go: binary files are not read twice.
+        with open(path, 'rb') as f:
+            data = f.read()
+        try:
+            data = io.StringIO(data.decode('utf-8'), newline='').readlines()
+            type = "t"
         except UnicodeDecodeError:
-            with open(path, 'rb') as f:
-                data = f.read()
-                type = "b"
+            type = "b"
 
         return (type, data)
         
+    def copyToData(self, src, datafname):
+        """
+        Copies the file src into the data directory of the file, as datafname, keeping its access and modification times.
+        
+        shutil.copyfile lets the kernel do the copy where possible (sendfile, copy_file_range), only the times are
+        copied afterwards, from a single stat of src.
+        """
+        stinfo = os.stat(src)
+        shutil.copyfile(src, self._dataprefix + datafname)
+        os.utime(self._dataprefix + datafname, ns=(stinfo.st_atime_ns, stinfo.st_mtime_ns))
+        self.written.append(self._dataprefix + datafname)
+        
     def createAtRevision(self, revision):
         """
         This is called during a commit when the file is created for the first time.
@@ -626,11 +985,12 @@ class VerConFile():
         Automatically detects text or binary.
         """
         
-        if len(self.events) > 0:
+        if self.events:
             raise VerConError("Trying to create a file that already has some historical data.")
         
-        filename = os.path.join(self.rootp,self.frelp,self.name)
-        type,data=self.textOrBinary(filename)
+        filename = self._userprefix + self.name
+        # the data itself is not needed, the file is copied as-is.
+        type,data=self.textOrBinary(filename, probe_only=True)
         if type == "t":
             datafname = "ET%d- %s"%(revision, self.name)
         elif type == "b":
@@ -638,13 +998,12 @@ class VerConFile():
                 
         self.loadEvent("e", revision, type, datafname)
        
-        # we will use shutil instead
-        shutil.copy2(os.path.join(self.rootp,self.frelp,self.name), os.path.join(self.datap,self.frelp,datafname))
+        self.copyToData(filename, datafname)
                     
         self.touch()
         
         
-    def changeAtRevision(self, revision):
+    def changeAtRevision(self, revision, modified=False):
         """
         This is called during a commit when the file is already existent.
         
@@ -655,27 +1014,38 @@ class VerConFile():
         Automatically detects text or binary.
         
         There should be no revisions equal to or after revision.
+        
+        If the file did not change since the last revision, it is only touched: no backup, no new event.
+        modified can be set to True by a caller that has just found the file modified (by isModified, see commitDirectories),
+        so that the files are not compared a second time.
         """
         
-        self.createBackup(revision)
         if self.hasE >= revision:
             raise VerConError("You are trying to do a commit at the same revision %d, or earlier as an existing commit %d. Please don't do that."%(revision, self.hasE))
             
         if revision <= self.lastrevision:
             raise VerConError("You are trying to do a commit at a version %d <= the latest version %d. This is bad. %s"%(revision, self.lastrevision, os.path.join(self.frelp,self.name)))
             
-        if len(self.events) == 0:
+        if not self.events:
             raise VerConError("You are trying to do a change to a file that has never been committed. That's a no-no")
 
+        if not modified and self.isUnchangedSinceLastRevision():
+            logger.debug("changeAtRevision: %s has not changed since revision %d, nothing to store."%(self.name, self.lastrevision))
+            self.touch()
+            return
+            
+        self.createBackup(revision)
+        
         lastevent = self.events[self.lastrevision]
 
-        filename = os.path.join(self.rootp,self.frelp,self.name)
-        type,data=self.textOrBinary(filename)
+        filename = self._userprefix + self.name
+        # only the lines of a text file are needed (for the delta), a binary file is copied as-is.
+        type,data=self.textOrBinary(filename, keep_binary=False)
 
 
         # the most simple case is for binary files: we need to copy existing E file into a H file, and create a new E file.
         if type == "b":
-            # we move the previous file into history.
+            # we move the previous file into history (a rename in the same directory: atomic, nothing is copied).
             if lastevent.event == "e":
                 if lastevent.type == "b":
                     fnbit = "HB"
@@ -686,7 +1056,8 @@ class VerConFile():
                     
                 newnameforhistory = "%s%d- %s"%(fnbit, self.lastrevision,self.name)
                     
-                shutil.move(os.path.join(self.datap, self.frelp, lastevent.fname), os.path.join(self.datap, self.frelp, newnameforhistory))
+                os.replace(self._dataprefix + lastevent.fname, self._dataprefix + newnameforhistory)
+                self.written.append(self._dataprefix + newnameforhistory)
             
                 # we move the previous event into history.
                 self.events[self.lastrevision].historicize(newnameforhistory)
@@ -712,19 +1083,22 @@ class VerConFile():
                 # if the type of the last event is binary, we just need to move the last event's file to history.
                 if lastevent.type == "b":                            
                     newnameforhistory = "HB%d- %s"%(self.lastrevision,self.name)                        
-                    shutil.move(os.path.join(self.datap, self.frelp, lastevent.fname), os.path.join(self.datap, self.frelp, newnameforhistory))
+                    os.replace(self._dataprefix + lastevent.fname, self._dataprefix + newnameforhistory)
+                    self.written.append(self._dataprefix + newnameforhistory)
                     
                 # otherwise we need to calculate the delta...
                 elif lastevent.type == "t":
                     newnameforhistory = "HT%d- %s"%(self.lastrevision,self.name)
                     
-                    with open(os.path.join(self.datap,self.frelp,newnameforhistory), "w", encoding="utf-8", newline='') as f:                    
+                    # the delta is streamed to the history file through a large buffer.
+                    with open(self._dataprefix + newnameforhistory, "w", encoding="utf-8", newline='', buffering=1<<20) as f:                    
                         olddata = ""
-                        with open(os.path.join(self.datap, self.frelp, lastevent.fname),"r", encoding="utf-8", newline='') as f2:
+                        with open(self._dataprefix + lastevent.fname,"r", encoding="utf-8", newline='') as f2:
                             olddata = f2.readlines()                            
-                        f.write(self.calculateDelta(data,olddata))
+                        self.calculateDeltaStream(data, olddata, f)
+                    self.written.append(self._dataprefix + newnameforhistory)
                     # we remove the now useless file.
-                    os.unlink(os.path.join(self.datap, self.frelp, lastevent.fname))  
+                    os.unlink(self._dataprefix + lastevent.fname)  
                     
                 else:
                     raise VerConError("FIle type %s not supported."%lastevent.type)
@@ -742,7 +1116,7 @@ class VerConFile():
         else:
             raise VerConError("File type %s not implemented."%type)
             
-        shutil.copy2(filename, os.path.join(self.datap,self.frelp,datafname))
+        self.copyToData(filename, datafname)
         
         """
         opentype = ""
@@ -778,7 +1152,7 @@ class VerConFile():
         if revision <= self.lastrevision:
             raise VerConError("You are trying to do a delete at a version (%d) <= the latest version (%d). This is bad."%(revision, self.lastrevision))
             
-        if len(self.events) == 0:
+        if not self.events:
             raise VerConError("You are trying to delete a file that has never been committed. That's a no-no")
 
         lastevent = self.events[self.lastrevision]
@@ -796,15 +1170,17 @@ class VerConFile():
             
         newnameforhistory = "%s%d- %s"%(bit, self.lastrevision, self.name)
         
-        shutil.move(os.path.join(self.datap, self.frelp, lastevent.fname), os.path.join(self.datap, self.frelp, newnameforhistory))
+        os.replace(self._dataprefix + lastevent.fname, self._dataprefix + newnameforhistory)
         self.events[self.lastrevision].historicize(newnameforhistory)
         self.hasE = -1
         
         # finally we create the delete event. It's just an empty file.
         
         newname = "D%d- %s"%(revision, self.name)
-        with open(os.path.join(self.datap, self.frelp, newname), "w", encoding="utf-8", newline='') as f:
-            f.write("")
+        # nothing is written, the file is only created (no text layer, no write call).
+        os.close(os.open(self._dataprefix + newname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644))
+        self.written.append(self._dataprefix + newnameforhistory)
+        self.written.append(self._dataprefix + newname)
             
         self.loadEvent("d", revision, "b", newname)
         self.lastrevision = revision
@@ -815,34 +1191,85 @@ class VerConFile():
         """
         Returns the event associated with revision, or None if file was not modified at that point.
         """
-        if revision in self.events.keys():
-            return self.events[revision]
-        else:
-            return None
+        return self.events.get(revision)
             
     def isNewlyCreated(self):
         """
         Returns true if there is only one event.
         """
-        return len(self.events.keys()) == 1
+        return len(self.events) == 1
         
-    def isModified(self):
+    def isModified(self, stinfo=None):
         """
         Returns true if the file in user space is different than the file in the repository.
+        
+        stinfo can be given the stat of the file in user space when the caller already has it (os.DirEntry.stat()
+        during a directory walk), so that it is not asked again.
+        
+        Files of different sizes are different, this is known from a single stat of each file. Files of the same
+        size are always compared by content, even when their modification dates are equal (an editor or a copy
+        may keep the date of a modified file).
+        
+        The contents are read by blocks of COMPARE_BLOCK bytes into two buffers that are allocated once per thread
+        and reused for every file (see compareBuffers), and compared as bytes (memcmp).
         """        
-        me = os.path.join(self.rootp, os.path.join(self.frelp, self.name))
+        me = self._userprefix + self.name
         other = self.getLastEventFileNameAndPath()
         logger.debug("isModified: Comparing %s with %s"%(me, other))
-        res = not filecmp.cmp(me, other, shallow=False)
+        if stinfo is None:
+            stinfo = os.stat(me)
+        if stinfo.st_size != os.stat(other).st_size:
+            logger.debug("isModified: sizes differ")
+            return True
+        res = False
+        b1, b2 = compareBuffers()
+        with open(me, "rb") as f1, open(other, "rb") as f2:
+            while True:
+                n1 = f1.readinto(b1)
+                n2 = f2.readinto(b2)
+                if n1 != n2:
+                    res = True
+                    break
+                if n1 < COMPARE_BLOCK:
+                    # last block: only the beginning of the buffers was filled (n1 == n2 here). Slices of bytearrays are
+                    # compared with memcmp, slices of memoryviews item by item.
+                    res = b1[:n1] != b2[:n2]
+                    break
+                if b1 != b2:
+                    res = True
+                    break
         logger.debug("isModified: result of comparison is %d (0: identical, 1: different)"%res)
-        # filecmp.clear_cache()
         return res
         
+    def isUnchangedSinceLastRevision(self):
+        """
+        Returns true if the last event is an existing file (E) whose content is identical to the file in user space.
+        
+        The sizes are compared first, the content only if they are equal (see isModified). A deleted file (D) is
+        never considered unchanged, as it has to be recreated.
+        """
+        if self.events[self.lastrevision].event != "e":
+            return False
+        
+        return not self.isModified()
+        
     def createBackup(self, revision):
         """
         Creates the backup of the file at given revision (for the safety mechanism)
+        
+        The backup is a hard link to the data file: data files are never rewritten in place, only renamed
+        or deleted by a commit, so the link keeps the old contents without copying them. Where hard links
+        are not available (some file systems), the file is copied by shutil.copyfile (in the kernel where possible),
+        and only the times are copied afterwards, from a single stat of the source.
         """
-        shutil.copy2(self.getLastEventFileNameAndPath(), os.path.join(self.datap, os.path.join(self.frelp, "BAK%d- %s"%(revision, self.events[self.lastrevision].fname))))
+        src = self.getLastEventFileNameAndPath()
+        dst = self._dataprefix + "BAK%d- %s"%(revision, self.events[self.lastrevision].fname)
+        try:
+            os.link(src, dst)
+        except OSError:
+            stinfo = os.stat(src)
+            shutil.copyfile(src, dst)
+            os.utime(dst, ns=(stinfo.st_atime_ns, stinfo.st_mtime_ns))
     
 
 class VerConDirectory():
@@ -856,11 +1283,14 @@ class VerConDirectory():
     And it can be in status active or deleted depending on the revision on which we are checking.
     
     This class does not handle the physical creation of directories (done during commit instead).
+    
+    There is one instance per directory of the repository, the attributes are declared in __slots__.
     """
+    __slots__ = ("name", "children", "_sorted_children", "childfiles", "history", "_history_str", "parent", "maxrevision", "touched", "path")
     
     def __init__(self, metadata=[], parent=None):
         """
-        Initialization using a list of lines from metadatadir.txt (as taken by readlines())
+        Initialization using a list of lines from metadatadir.txt (as taken by readlines(), or without their \n)
         lines of the form [<space>,[<space>]...]revision,[revision,[revision...]] directoryname
         
         - if space(s) are present, the directory is a subdirectory of the directory above it.
@@ -869,25 +1299,40 @@ class VerConDirectory():
         - if parent is not none, we expect a 2-uple in the metadata : name, history.
         """
         
-        if parent != None:
-            self.name = metadata[0]
+        if parent is not None:
+            name, history = metadata
+            self.name = name
             self.children = {}
+            # the names of the children, kept sorted by addChild (the order in which the tree is written).
+            self._sorted_children = []
             self.childfiles = {}
-            self.history = metadata[1]
+            self.history = history
+            # the history as written in metadatadir.txt, computed when needed (see iterSerialize).
+            self._history_str = None
             self.parent = parent
-            self.maxrevision = metadata[1][-1]
+            self.maxrevision = history[-1]
             self.touched = False
+            # directories are never moved in the tree, so their path is computed once (a plain
+            # concatenation: the names are single path components, os.path.join has nothing to check).
+            if parent.path != "":
+                self.path = parent.path + os.sep + name
+            else:
+                self.path = name
         
         else:
             
             # default values (for the root node)
             self.name = ""
             self.children = {}
+            # the names of the children, kept sorted by addChild (the order in which the tree is written).
+            self._sorted_children = []
             self.childfiles = {}
             self.history = [0]
+            self._history_str = None
             self.parent = None
             self.maxrevision = 0
             self.touched = False
+            self.path = ""
 
             # initial level (of the root) is -1
             level = -1
@@ -897,19 +1342,25 @@ class VerConDirectory():
             # let's create the tree...
             for line in metadata:        
                 logger.debug("VerConDirectory constructor: we have line %r"%line)
-                # \\r resolves an issue in case 
-                data = re.match(r"^( *)(\d+(?:,\d+)*) (.*?)(?:\r)?$", line)
-                if data != None:
-                    newlevel = len(data.group(1))
+                # the line is cut with string methods: indentation, then the history up to the first space,
+                # then the name (without its end of line, \r resolves an issue in case of Windows files).
+                stripped = line.lstrip(" ")
+                newlevel = len(line) - len(stripped)
+                head, sep, name = stripped.partition(" ")
+                parts = head.split(",")
+                if sep != "" and all(d.isascii() and d.isdigit() for d in parts):
                     if newlevel > level + 1:
                         raise VerConError("Data integrity issue: too many spaces")     
 
-                    history = []
-                    for d in data.group(2).split(","):
-                        history.append(int(d))
-                        if int(d) > self.maxrevision:
-                            self.maxrevision = int(d)
-                    name = data.group(3)
+                    history = [int(d) for d in parts]
+                    self.maxrevision = max(self.maxrevision, max(history))
+                    if name.endswith("\n"):
+                        name = name[:-1]
+                    if name.endswith("\r"):
+                        name = name[:-1]
+                    # names are interned: the same directory names come back in many places of a tree,
+                    # and the lookups by name in the children dicts then compare identical strings.
+                    name = sys.intern(name)
 
                     # do we have a child node?
                     if newlevel == level + 1:
@@ -924,10 +1375,12 @@ class VerConDirectory():
                     logger.debug("VerConDirectory constructor: calculated directory name: %r"%name)
 
                     node = currentpath[-1].addChild(name, history)
+                    # the history as read is kept to be written back as-is, unless the directory changes.
+                    node._history_str = head
                     lastnode = node
                     level = newlevel
                 else:
-                    raise VerConError("Data integrity issue: line '%s' does not match regexp"%line)                
+                    raise VerConError("Data integrity issue: line '%s' is not of the form 'history name'"%line)                
         
 
     def addContentFile(self, path, name, fileobject):
@@ -939,17 +1392,14 @@ class VerConDirectory():
         
         Raises an exception if the file is already stored.
         
+        The directory is found by tryAtPath. Callers that already hold the node of the directory (such as
+        precomputeFileDB and commitDirectories) call this on it with an empty path, so nothing is walked.
         """
-        location = self
-        if len(path) > 0:
-            bits = path.split(os.sep)
-            for b in bits:
-                if b not in location.children.keys():
-                    raise VerConError("Trying to add a file to a directory that was not initialized, what kind of joke is that")
-                
-                location = location.children[b]
+        location = self.tryAtPath(path)
+        if location is None:
+            raise VerConError("Trying to add a file to a directory that was not initialized, what kind of joke is that")
         
-        if name in location.childfiles.keys():
+        if name in location.childfiles:
             raise VerConError("Trying to add file %s into database while it already exists."%name)
             
         if fileobject.getLastRevision() > self.maxrevision:
@@ -960,22 +1410,14 @@ class VerConDirectory():
     def findContentFile(self, path, name):
         """
         Returns a pointer to the file object if "name" is found, or None if not exist.
-        """
-
-        location = self
-        if len(path) > 0:
-            bits = path.split(os.sep)
-            for b in bits:
-                if b not in location.children.keys():
-                    raise VerConError("Trying to find a file in a directory that was not initialized, what kind of joke is that")
-                
-                location = location.children[b]
         
-        if name in location.childfiles.keys():
-            return location.childfiles[name]
+        Like addContentFile, the directory is found by tryAtPath (nothing is walked for an empty path).
+        """
+        location = self.tryAtPath(path)
+        if location is None:
+            raise VerConError("Trying to find a file in a directory that was not initialized, what kind of joke is that")
         
-        else:
-            return None
+        return location.childfiles.get(name)
 
     def addChild(self, name, history):
         """
@@ -984,6 +1426,8 @@ class VerConDirectory():
         returns the created node.
         """
         node = VerConDirectory([name, history], self)
+        if name not in self.children:
+            bisect.insort(self._sorted_children, name)
         self.children[name] = node
         return node
 
@@ -1006,29 +1450,67 @@ class VerConDirectory():
         Marked directories which has self.touch not true, to deleted.
         
         Returns the number of directories affected. 0 then means no change.
+        
+        The tree is walked with a stack instead of recursive calls. Only the directories seen by the commit and the ones
+        it deletes are walked, the history of directories deleted before is skipped.
         """
         count = 0
         
-        for k,c in self.children.items():
-            # we delete active directories that are not touched.
-            if not c.isTouched() and c.isActiveAt(revision):
-                logger.debug("markUntouchedDeleted: %s was not touched, changing its status."%k)
-                c.toggleState(revision)
-                c.touch()
-                if revision > self.getMaxRevision():
-                    self.maxrevision = revision
-                count += 1
-            count += c.markUntouchedDeleted(revision)
-            
-        for k,c in self.childfiles.items():
-            # we delete active files that are not touched.
-            if (not c.isTouched()) and c.existsAt(revision) :
-                logger.debug("markUntouchedDeleted: we delete a file %s"%c)
-                c.deleteAtRevision(revision)
-                count += 1                
+        stack = [self]
+        # bound once, used for every directory.
+        push = stack.append
+        while len(stack) > 0:
+            node = stack.pop()
+            for k,c in node.children.items():
+                if not c.isTouched():
+                    # a directory deleted by an earlier commit had its files and children deleted with it:
+                    # there is nothing left to delete below, it is not walked.
+                    if not c.isActiveAt(revision):
+                        continue
+                    # we delete active directories that are not touched.
+                    logger.debug("markUntouchedDeleted: %s was not touched, changing its status."%k)
+                    c.toggleState(revision)
+                    c.touch()
+                    if revision > node.maxrevision:
+                        node.maxrevision = revision
+                    count += 1
+                push(c)
+                
+            for k,c in node.childfiles.items():
+                # we delete active files that are not touched.
+                if (not c.isTouched()) and c.existsAt(revision) :
+                    logger.debug("markUntouchedDeleted: we delete a file %s"%c)
+                    c.deleteAtRevision(revision)
+                    count += 1                
             
         return count
 
+    def clearTouched(self):
+        """
+        Clears the touched flag of all the directories and files of the tree, so that a new commit starts
+        with nothing touched (see markUntouchedDeleted). The tree is walked with a stack.
+        """
+        stack = [self]
+        while len(stack) > 0:
+            node = stack.pop()
+            node.touched = False
+            for f in node.childfiles.values():
+                f.touched = False
+            stack.extend(node.children.values())
+
+    def collectWritten(self, paths):
+        """
+        Appends to paths the data files written by the files of this directory and its children
+        during the current commit, and empties their lists. The tree is walked with a stack.
+        """
+        stack = [self]
+        while len(stack) > 0:
+            node = stack.pop()
+            for c in node.childfiles.values():
+                paths.extend(c.written)
+                c.written = []
+            stack.extend(node.children.values())
+
     def getMaxRevision(self):
         """
         Returns the maximal revision of the directory database (== last change of a directory in history)
@@ -1043,27 +1525,9 @@ class VerConDirectory():
 
     def getPath(self):
         """
-        Returns the current path
+        Returns the current path (computed once by the constructor, from the path of the parent).
         """
-        if self.name != "":
-            pathbits = [self.name]
-        else:
-            pathbits = []
-        node = self.parent
-        while node != None:
-            pathbits.append(node.name)
-            node = node.parent
-            
-        pathbits.reverse()
-        if len(pathbits) > 1:
-            bit = pathbits[0]
-            for other in pathbits[1:]:
-                bit = os.path.join(bit, other)
-            return bit
-        elif len(pathbits) == 1:
-            return pathbits[0]
-        else:
-            return ""
+        return self.path
         
     def atPath(self, path):
         """
@@ -1073,25 +1537,31 @@ class VerConDirectory():
         
         if path is the empty string, returns self.
         """
+        curnode = self.tryAtPath(path)
+        if curnode is None:
+            raise VerConError("Directory '%s' is not in repository"%path)
+        return curnode
+        
+    def tryAtPath(self, path):
+        """
+        Same as atPath, but returns None if the path does not exist.
+        
+        To be used where a missing directory is an expected case, rather than an error: no exception is created.
+        """
         curnode = self
         
         if len(path) > 0:
-            bits = path.split(os.sep)
-            
-            for b in bits:
-                if b in curnode.children.keys():
-                    curnode = curnode.children[b]
-                else:
-                    raise VerConError("Directory '%s' is not in repository"%path)
+            for b in path.split(os.sep):
+                curnode = curnode.children.get(b)
+                if curnode is None:
+                    return None
         return curnode
         
     def getChild(self, name):
         """
         Returns the child or None if name is not found.
         """
-        if name not in self.children.keys():
-            return None
-        return self.children[name]
+        return self.children.get(name)
         
     def Add(self, path, revision):
         """
@@ -1108,13 +1578,13 @@ class VerConDirectory():
         curnode = self
         isnew = False
         for b in bits:
-            if b in curnode.children.keys():
-                curnode = curnode.children[b]
+            child = curnode.children.get(b)
+            if child is not None:
+                curnode = child
                 if not curnode.isCurrentlyActive():
                     curnode.toggleState(revision)
             else:
-                curnode.addChild(b, [revision])
-                curnode = curnode.children[b]
+                curnode = curnode.addChild(b, [revision])
                 isnew = True
         
         if not isnew:
@@ -1129,6 +1599,7 @@ class VerConDirectory():
         This has the effect to activate or desactivate the directory.
         """
         self.history.append(revision)
+        self._history_str = None
         logger.debug("toggleState: History is %s for %s"%(self.history,self.getPath()))
                    
     def isCurrentlyActive(self):
@@ -1140,16 +1611,11 @@ class VerConDirectory():
     def isActiveAt(self, revision):
         """
         Returns true if the directory is active at a given revision number.
-        """
         
-        # by default, the directory does not exist.
-        active = False
-        for arev in self.history:
-            if arev > revision:
-                break
-            active = not active
-        
-        return active
+        The history is in increasing order, and the directory is active when an odd number of its
+        creations/deletions happened at or before revision.
+        """
+        return bisect.bisect_right(self.history, revision) % 2 == 1
         
     def hasChildren(self):
         """
@@ -1201,46 +1667,50 @@ class VerConDirectory():
         - list of directories to create
         
         revision: the revision number to restore to
-        regexp: a compiled regular expression used as a filter
+        regexp: a compiled regular expression used as a filter, or None to take all the files without matching
         dirElement: the directory root, used to travel recursively.
         
         returns: a 4-uple of lists like indicated above : (files to delete, directories to delete, files to restore, directories to create)   
+        
+        The tree is walked with a stack instead of recursive calls, in the same order (a directory, then its
+        files, then its children in order), so the lists are built once instead of being merged at each level.
         """
         filedelete = []
         filerestore = []
         dirdelete = []
         dircreate = []
-        
-        logger.debug("restoreListPrepare: Entering %s"%self.getPath())
-
-        # the directory did not exist at revision X:
-        if not self.isActiveAt(revision):
-            logger.debug("restoreListPrepare: %s not active at %d"%(self.getPath(), revision))
-            tmpf, tmpd = self.getDeleteList()
-            filedelete.extend(tmpf)
-            dirdelete.extend(tmpd)
-        else:
-            logger.debug("restoreListPrepare: %s active at %d"%(self.getPath(), revision))
-            # here, do something, such as listing the files etc.
-            dircreate.append(self)
-            for k,f in self.childfiles.items():
-                # process the files...
-                # we check if matches regexp (this is only checked on FILES).
-                if regexp.match(os.path.join(f.frelp, f.name)):
-                    logger.debug("restoreListPrepare: Matched %s"%os.path.join(f.frelp, f.name))
+        match = regexp.match if regexp is not None else None
+        
+        stack = [self]
+        while len(stack) > 0:
+            node = stack.pop()
+            logger.debug("restoreListPrepare: Entering %s"%node.getPath())
+
+            # the directory did not exist at revision X:
+            if not node.isActiveAt(revision):
+                logger.debug("restoreListPrepare: %s not active at %d"%(node.getPath(), revision))
+                tmpf, tmpd = node.getDeleteList()
+                filedelete.extend(tmpf)
+                dirdelete.extend(tmpd)
+            else:
+                logger.debug("restoreListPrepare: %s active at %d"%(node.getPath(), revision))
+                # here, do something, such as listing the files etc.
+                dircreate.append(node)
+                for k,f in node.childfiles.items():
+                    # process the files...
+                    # we check if matches regexp (this is only checked on FILES).
+                    if match is not None:
+                        relname = os.path.join(f.frelp, f.name)
+                        if not match(relname):
+                            logger.debug("restoreListPrepare: Did not match %s"%relname)
+                            continue
+                        logger.debug("restoreListPrepare: Matched %s"%relname)
                     if f.existsAt(revision):
                         filerestore.append(f)
                     else:
                         filedelete.append(f)
-                else:
-                    logger.debug("restoreListPrepare: Did not match %s"%os.path.join(f.frelp, f.name))
-                    pass
-            for k,d in self.children.items():
-                tmpfd, tmpfr, tmpdd, tmpdc = d.restoreListPrepare(revision, regexp)
-                filedelete.extend(tmpfd)
-                filerestore.extend(tmpfr)
-                dirdelete.extend(tmpdd)
-                dircreate.extend(tmpdc)
+                # reversed, so that the first child is the next one popped.
+                stack.extend(reversed(list(node.children.values())))
         
         logger.debug("restoreListPrepare: Leaving with: files to delete: %s, files to restore: %s, dirs to delete: %s, dirs to create: %s"%(filedelete, filerestore, dirdelete, dircreate))
                 
@@ -1251,7 +1721,7 @@ class VerConDirectory():
         Restores files and directories to the given revision.
         
         revision: the revision number to restore to
-        regexp: a compiled regular expression used as a filter
+        regexp: a compiled regular expression used as a filter, or None to restore all the files
         
         
         Stage 1 : browse DATA tree for matching directories and files.
@@ -1294,20 +1764,21 @@ class VerConDirectory():
         # Stage 3: let's revert stuff!
         # 3.1 first create directories (if necessary)
         for d in dircreate:
-            if os.path.exists(os.path.join(rootdir, d.getPath())):
-                if not os.path.isdir(os.path.join(rootdir, d.getPath())):
+            # the directory is created directly, it is only checked when it already exists.
+            dabs = os.path.join(rootdir, d.getPath())
+            try:
+                os.mkdir(dabs)
+            except FileExistsError:
+                if not os.path.isdir(dabs):
                     raise VerConError("Trying to recreate %s but there is a file with the same name, aborting"%d.getPath())
-            else:
-                os.mkdir(os.path.join(rootdir, d.getPath()))
                 
-        # 3.2 then let's restore the files
-        for f in filerestore:
-            if f.fTypeAt(revision) == "b":
-                with open(os.path.join(rootdir, f.frelp, f.name), "wb") as out:
-                    out.write(f.contentsAt(revision))
-            else:
-                with open(os.path.join(rootdir, f.frelp, f.name), "w", encoding="utf-8", newline='') as out:
-                    out.write(f.contentsAt(revision))                
+        # 3.2 then let's restore the files (each file is independent from the others, they are restored
+        # in a pool of threads, the first error met is raised again).
+        if len(filerestore) > 0:
+            with ThreadPoolExecutor(max_workers=min(len(filerestore), os.cpu_count() or 1)) as executor:
+                futures = [executor.submit(f.restoreAt, revision, os.path.join(rootdir, f.frelp, f.name)) for f in filerestore]
+            for future in futures:
+                future.result()
 
                 
         # 3.3 finally we delete the files we don't want
@@ -1332,24 +1803,27 @@ class VerConDirectory():
         This helper function raises VerConError if it finds a modified file in the tree
         under a directory that is flagged as "deletable" by restore To.
         """
-        try:
-            for item in os.scandir(os.path.join(rootdir, path)):
-                if item.is_dir() and item.name != "REPO":
-                    try:
-                        d = self.atPath(os.path.join(path, item.name))
-                    except VerConError:
-                        raise VerConError("%s is a directory not committed to the tree. Please delete this directory or commit it. Aborting."%os.path.join(path, item.name))
-                    self.CheckModifiedOrNewFilesInDir(rootdir, os.path.join(path, item.name))
+        # a directory or a file removed meanwhile is skipped alone, the other ones are still checked.
+        for dirpath, relPath, entries in walkUserTree(os.path.join(rootdir, path), path, skipMissing=True):
+            # a directory missing from the database stops the walk before it is entered.
+            node = self.tryAtPath(relPath)
+            for item in entries:
+                if item.is_dir():
+                    if node is None or node.getChild(item.name) is None:
+                        raise VerConError("%s is a directory not committed to the tree. Please delete this directory or commit it. Aborting."%os.path.join(relPath, item.name))
                 elif item.is_file():
-                    f = None
-                    try:
-                        f = self.findContentFile(path, item.name)                    
-                    except VerConError:
-                        raise VerConError("%s is a file not committed to the tree. Please delete this file or commit it. Aborting."%os.path.join(path, item.name))
-                    if f.isModified() and revision != self.getMaxRevision():
-                        raise VerConError("%s has been modified since last commit, please revert or commit changes."%os.path.join(path, item.name))
-        except FileNotFoundError:
-            logger.debug("CheckModifiedOrNewFilesInDir: It seems that %s is not present in user space, skipping."%os.path.join(rootdir, path))
+                    f = node.childfiles.get(item.name) if node is not None else None
+                    if f is None:
+                        raise VerConError("%s is a file not committed to the tree. Please delete this file or commit it. Aborting."%os.path.join(relPath, item.name))
+                    if revision != self.getMaxRevision():
+                        try:
+                            # the stat of the directory entry is reused by isModified.
+                            modified = f.isModified(item.stat())
+                        except FileNotFoundError:
+                            logger.debug("CheckModifiedOrNewFilesInDir: It seems that %s is not present in user space, skipping."%item.path)
+                            continue
+                        if modified:
+                            raise VerConError("%s has been modified since last commit, please revert or commit changes."%os.path.join(relPath, item.name))
         
     def Serialize(self,level=-1, debug=False):
         """
@@ -1357,28 +1831,44 @@ class VerConDirectory():
         
         If debug is true, also prints the list of files in the repository.
         """
-        lines = []
+        return list(self.iterSerialize(level, debug))
+        
+    def iterSerialize(self, level=-1, debug=False):
+        """
+        Same as Serialize, but the lines are generated one by one, to be written as they come.
         
-        # if we are at root, we skip this.
-        if self.name != "":        
-            name = self.name
-            history = self.history
-            line = "%s"%(' '*level)
-            h=[]
-            for i in history:
-                h.append(str(i))
-            line += ",".join(h)
-            line += " %s"%name
-            lines.append(line)
-        
-        if debug:
-            for f in sorted(self.childfiles.keys()):
-                lines.append("%s- %s"%(' '*level, self.childfiles[f].__repr__()))      
-        if self.hasChildren():                
-            for k in sorted(self.children.keys()):
-                lines.extend(self.children[k].Serialize(level + 1, debug=debug))
-
-        return lines    
+        The tree is walked with a stack of (node, level) instead of nested generators, so that each line is
+        handed out directly whatever the depth of its directory. The history of a directory is only formatted
+        if it changed since metadatadir.txt was read (most directories are written back as they were read).
+        """
+        stack = [(self, level)]
+        # bound once, used for every directory.
+        push = stack.append
+        while len(stack) > 0:
+            node, level = stack.pop()
+            # if we are at root, we skip this.
+            if node.name != "":        
+                if node._history_str is None:
+                    node._history_str = ",".join(map(str, node.history))
+                yield "%s%s %s"%(' '*level, node._history_str, node.name)
+            
+            if debug:
+                for f in sorted(node.childfiles):
+                    yield "%s- %s"%(' '*level, node.childfiles[f].__repr__())
+            # reversed, so that the children are popped in sorted order.
+            children = node.children
+            for k in reversed(node._sorted_children):
+                push((children[k], level + 1))
+        
+    def serializeTo(self, out):
+        """
+        Writes the same text as __repr__ to out (a text stream), line by line, without building it as a whole in memory.
+        """
+        sep = ""
+        for line in self.iterSerialize():
+            out.write(sep)
+            out.write(line)
+            sep = "\n"
         
     def __repr__(self):
         """ Pretty printout """
@@ -1407,7 +1897,7 @@ class VerConDirectory():
                     lines.append("  +d %s"%self.getPath())                  
         for k,f in sorted(self.childfiles.items()):
             e = f.getEventAtRevision(lastcommit)
-            if e != None:
+            if e is not None:
                 token = ""
                 if e.event == "e":
                     if f.isNewlyCreated():
@@ -1420,7 +1910,8 @@ class VerConDirectory():
                 else:
                     token = "-f"
                 lines.append("  %s %s"%(token, os.path.join(f.frelp,f.name)))
-        for k, d in sorted(self.children.items()):
+        for k in self._sorted_children:
+            d = self.children[k]
             lines.extend(d.generateCommitLog(lastcommit))
         
         return lines
@@ -1439,10 +1930,11 @@ class VerConRepository():
         self.datadir = None
         self.lastcommit = 0
         self.dirDb = None
+        self.lockfd = None
         
         path = os.path.abspath(directory)
         drive,path = os.path.splitdrive(path)
-        while len(path)>1 and self.repodir == None: # path will contain a leading / or \
+        while len(path)>1 and self.repodir is None: # path will contain a leading / or \
             if not os.path.isdir(os.path.join(drive, path, "REPO")):
                 path,end=os.path.split(path)
             else:
@@ -1459,14 +1951,19 @@ class VerConRepository():
 
                 # now we can create our data structure with (hopefully) clean data.
                 with open(os.path.join(self.repodir, "metadatadir.txt"),"r", encoding="utf-8", newline='') as f:
-                    self.dirDb   = VerConDirectory(f.readlines())
+                    # read in one go and cut on \n only (splitlines would also cut on characters that can be
+                    # part of a directory name), a final \n does not make an empty line.
+                    lines = f.read().split("\n")
+                    if lines[-1] == "":
+                        lines.pop()
+                    self.dirDb   = VerConDirectory(lines)
                     self.precomputeFileDB(self.datadir, "")
                     
                     self.lastcommit = max(self.dirDb.getMaxRevision(), self.lastcommit)
                     self.dirDb.setMaxRevision(self.lastcommit)
                     
 
-        if self.repodir == None:
+        if self.repodir is None:
             os.mkdir(os.path.join(directory, "REPO"))
             os.mkdir(os.path.join(directory, "REPO", "DATA"))
             self.repodir = os.path.join(directory, "REPO")
@@ -1502,6 +1999,29 @@ class VerConRepository():
         """
         return self.lastcommit
         
+    def readLastCommit(self):
+        """
+        Returns the revision number of the last commit recorded in commits.txt, or 0 if there is none.
+        
+        Only the end of the file is read, by blocks growing until the first line of the last entry is found.
+        """
+        with open(os.path.join(self.repodir, "commits.txt"), "rb") as f:
+            size = f.seek(0, os.SEEK_END)
+            block = 1<<16
+            while True:
+                start = max(0, size - block)
+                f.seek(start)
+                data = f.read(size - start).decode("utf-8", "replace")
+                last = None
+                for last in LOG_HEADER_RE.finditer(data):
+                    pass
+                # a header cut by the start of the block is not a header, unless the block starts the file.
+                if last is not None and (last.start() > 0 or start == 0):
+                    return int(last.group(1))
+                if start == 0:
+                    return 0
+                block *= 2
+        
     def commit(self, comment):
         """ commit changes to the repository in or above directory, with comment comment.
             creates new repository in directory if none found.
@@ -1510,9 +2030,22 @@ class VerConRepository():
         
         self.lockRepository()
         
+        # the state was loaded before the lock was taken: another object may have committed since.
+        ondisk = self.readLastCommit()
+        if ondisk != self.lastcommit:
+            self.unlockRepository()
+            raise VerConError("The repository has been changed by another process (last commit %d instead of %d), please reload it."%(ondisk, self.lastcommit))
+        
+        # the flags of a previous commit done with this object would hide the deletions.
+        self.dirDb.clearTouched()
+        
         # Stage 1 : check directories and files
         logger.debug("commit: Current commit number %d (new commit will be +1)"%self.lastcommit)
-        newcommit = self.commitDirectories(self.lastcommit, self.getBaseDir(), "")
+        changed = []
+        newcommit = self.commitDirectories(self.lastcommit, self.getBaseDir(), "", changed)
+        
+        # Stage 1b : store the modified files (this is independent from one file to another)
+        self.changeFiles(changed, newcommit)
         
         # Stage 2 : check if anything is to be deleted:
         count = self.dirDb.markUntouchedDeleted(self.lastcommit + 1)
@@ -1522,103 +2055,193 @@ class VerConRepository():
 
         # Stage 3 : if something changed, save directory database.
         if newcommit > self.lastcommit:
+            # the data files are on disk before the metadata that refers to them.
+            written = []
+            self.dirDb.collectWritten(written)
+            self.syncToDisk(written)
+            
             self.backupMetadata(newcommit)
             self.lastcommit = newcommit
                         
-            with open(os.path.join(self.repodir, "metadatadir.txt"),"w", encoding="utf-8", newline='') as f:
-                f.write(self.dirDb.__repr__())
+            # written aside then renamed, so that metadatadir.txt is never left half written.
+            with open(os.path.join(self.repodir, "metadatadir.txt.new"),"w", encoding="utf-8", newline='', buffering=1<<20) as f:
+                self.dirDb.serializeTo(f)
+            os.replace(os.path.join(self.repodir, "metadatadir.txt.new"), os.path.join(self.repodir, "metadatadir.txt"))
                        
-            lines = ["%d. %s"%(self.lastcommit, comment)]
-        
-            lines.extend(self.dirDb.generateCommitLog(self.lastcommit))
+            # the entry is gathered in the buffer of the file and reaches it in a single write when the file is closed.
+            with open(os.path.join(self.repodir, "commits.txt"), "a", encoding="utf-8", newline='', buffering=1<<20) as f:
+                f.write("%d. %s\n"%(self.lastcommit, comment))
+                f.writelines(line + "\n" for line in self.dirDb.generateCommitLog(self.lastcommit))
+                f.write("\n")
             
-            with open(os.path.join(self.repodir, "commits.txt"), "a", encoding="utf-8", newline='') as f:
-                f.write("\n".join(lines))
-                f.write("\n\n")
-                
+            # and the metadata is on disk before the LOCK is removed.
+            self.syncToDisk([os.path.join(self.repodir, "metadatadir.txt"), os.path.join(self.repodir, "commits.txt")])
                 
         self.unlockRepository()
         self.cleanup(self.lastcommit)
                 
+    def syncToDisk(self, paths):
+        """
+        Flushes the files in paths to disk, then their directories (so that creations and renames are durable too).
+        
+        The commit writes its data files without waiting for the disk, and flushes them here before writing the
+        metadata: the system does not keep the order of the writes to different files, and the metadata must not
+        be on disk before the data it refers to. This costs one fsync per data file written by the commit (the
+        changed files only, not the whole tree) and one per directory holding them. The files are flushed together
+        from a pool of threads, so that the file system can gather them in the same journal commit instead of
+        waiting for the disk once per file (group commit), and each directory is synced only once whatever its
+        number of files.
+        """
+        if len(paths) == 0:
+            return
+            
+        with ThreadPoolExecutor(max_workers=min(len(paths), os.cpu_count() or 1)) as executor:
+            futures = [executor.submit(fsyncPath, p) for p in paths]
+        for future in futures:
+            future.result()
+            
+        # a renamed file may have been renamed again since, its directory is synced all the same.
+        for d in set(os.path.dirname(p) for p in paths):
+            fsyncPath(d, True)
+        
     def backupMetadata(self, commitnumber):
         """
         This function saves metadatadir.txt and commits.txt into a backup of current commit.
         We suppose a clean directory.
+        
+        metadatadir.txt is never rewritten in place (a new one is renamed over it), so its backup is a hard link
+        where possible (see VerConFile.createBackup). commits.txt is appended to, so it is really copied.
+        """
+        src = os.path.join(self.repodir, "metadatadir.txt")
+        dst = os.path.join(self.repodir, "BAK%d- metadatadir.txt"%commitnumber)
+        try:
+            os.link(src, dst)
+        except OSError:
+            stinfo = os.stat(src)
+            shutil.copyfile(src, dst)
+            os.utime(dst, ns=(stinfo.st_atime_ns, stinfo.st_mtime_ns))
+            
+        src = os.path.join(self.repodir, "commits.txt")
+        dst = os.path.join(self.repodir, "BAK%d- commits.txt"%commitnumber)
+        stinfo = os.stat(src)
+        shutil.copyfile(src, dst)
+        os.utime(dst, ns=(stinfo.st_atime_ns, stinfo.st_mtime_ns))
+        
+    def changeFiles(self, files, commitnumber):
+        """
+        Calls changeAtRevision(commitnumber) for each of the VerConFile in files. These files were all found
+        modified by commitDirectories, they are not compared again.
+        
+        Each file only works on its own data files, so the changes are run in a pool of threads
+        (reading, diffing and writing files overlap). The first error met is raised again.
         """
-        shutil.copy2(os.path.join(self.repodir, "metadatadir.txt"),os.path.join(self.repodir, "BAK%d- metadatadir.txt"%commitnumber))
-        shutil.copy2(os.path.join(self.repodir, "commits.txt"),os.path.join(self.repodir, "BAK%d- commits.txt"%commitnumber))            
+        if len(files) == 0:
+            return
+            
+        with ThreadPoolExecutor(max_workers=min(len(files), os.cpu_count() or 1)) as executor:
+            futures = [executor.submit(f.changeAtRevision, commitnumber, True) for f in files]
+        for future in futures:
+            future.result()
         
-    def commitDirectories(self, commitnumber, baseDir, relPath):
+    def commitDirectories(self, commitnumber, baseDir, relPath, changed):
         """
         Checks for directories and adds, commits, or deletes them depending on their situation.
         
-        For each directory, checks if files were modified. If so, commits the file change, depending on the situation.
+        For each directory, checks if files were modified. If so, the file is added to the list changed,
+        and its change is committed by changeFiles once all directories are processed.
         Files in deleted directories will be marked as deleted.
         
+        The user space is read by walkUserTree, and each directory is kept along with its node in the database, so
+        that its children are found without looking them up from the root. The files already in the database
+        are compared to their last revision once the whole tree is walked, in a pool of threads.
+        A directory that has just been added to the database has no children nor files in it yet: everything under
+        it is added directly, without being looked up.
+        
         Returns the commit number : same as commitnumber if nothing changed, commitnumber+1 if something changed.
         """
         haschanged = False
         newcommit = commitnumber + 1
-        hasrepo = False
-        
-        # this is the root directory (relative to where we are talking about).
-        rdir = self.dirDb.atPath(relPath)
-        
-        for item in os.scandir(baseDir):
-            if item.is_dir() and item.name != "REPO":
-                try:
-                    logger.debug("commitDirectories: Checking if %s exists in db"%os.path.join(relPath, item.name))
-                    dir = self.dirDb.atPath(os.path.join(relPath, item.name))
-                    logger.debug("commitDirectories: It exists, continue.")
-                    if not dir.isCurrentlyActive():
-                        logger.debug("commitDirectories: reactivating %s"%dir.getPath())
-                        dir.toggleState(newcommit)
-                        haschanged = True
-                        dir.touch()
-                    # it already exists and is already active, we just touch it.
+        # the files already in the database, with their stat, to be checked for modifications.
+        known = []
+        
+        # the node of each directory walked and whether it has just been added, by relative path, starting with
+        # the root directory (relative to where we are talking about).
+        nodes = {relPath: (self.dirDb.atPath(relPath), False)}
+        # the data directory with a trailing separator, the relative paths are appended to it.
+        dataPrefix = os.path.join(self.getDataDir(), "")
+        
+        for baseDir, relPath, entries in walkUserTree(baseDir, relPath):
+            rdir, isnew = nodes.pop(relPath)
+            # the files of the directory, by name.
+            files = rdir.childfiles
+            # built like in walkUserTree, so that the paths match the keys of nodes.
+            prefix = relPath + os.sep if relPath != "" else ""
+            
+            for item in entries:
+                if item.is_dir():
+                    # the relative path of the directory, and its path in REPO/DATA, are built once.
+                    childRel = prefix + item.name
+                    logger.debug("commitDirectories: Checking if %s exists in db"%childRel)
+                    dir = None if isnew else rdir.getChild(item.name)
+                    dirnew = dir is None
+                    if not dirnew:
+                        logger.debug("commitDirectories: It exists, continue.")
+                        if not dir.isCurrentlyActive():
+                            logger.debug("commitDirectories: reactivating %s"%dir.getPath())
+                            dir.toggleState(newcommit)
+                            haschanged = True
+                            dir.touch()
+                        # it already exists and is already active, we just touch it.
+                        else:
+                            dir.touch()
+                        
                     else:
+                        # the directory did not exist, we create it in the db + physically in REPO/DATA
+                        dir = rdir.Add(item.name,newcommit)
                         dir.touch()
+                        childData = dataPrefix + childRel
+                        logger.debug("commitDirectories: Creating %s"%childData)
+                        # directory may already exist (in case for example of a crashed commit where a new directory is added).
+                        try:
+                            os.mkdir(childData)
+                        except FileExistsError:
+                            if not os.path.isdir(childData):
+                                raise VerConError("Error: a file has the same name as the directory being tried to create: %s. This is a major problem."%childData)
+                        haschanged = True         
                     
-                except VerConError:
-                    # the directory did not exist, we create it in the db + physically in REPO/DATA
-                    dir = self.dirDb.Add(os.path.join(relPath, item.name),newcommit)
-                    dir.touch()
-                    logger.debug("commitDirectories: Creating %s"%os.path.join(self.getDataDir(), relPath, item.name))
-                    # directory may already exist (in case for example of a crashed commit where a new directory is added).
-                    try:
-                        os.mkdir(os.path.join(self.getDataDir(), relPath, item.name))
-                    except FileExistsError:
-                        if not os.path.isdir(os.path.join(self.getDataDir(), relPath, item.name)):
-                            raise VerConError("Error: a file has the same name as the directory being tried to create: %s. This is a major problem."%os.path.join(self.getDataDir(), relPath, item.name))
-                    haschanged = True         
-                
-                # recursive call for directory's childrens
-                commit = self.commitDirectories(commitnumber, os.path.join(baseDir, item.name), os.path.join(relPath, item.name))
-                if commit != commitnumber:
-                    haschanged = True
-            # let's handle file changes.
-            elif item.is_file():
-                fobj = rdir.findContentFile("", item.name)
-                # file is already in database, let's see if it was modified...
-                if fobj != None:
-                    logger.debug("commitDirectories: Found file %s (working in %s)"%(fobj, relPath))
-                    if fobj.isModified():
-                        logger.debug("commitDirectories: - %s has changed."%fobj)
-                        fobj.changeAtRevision(newcommit)
-                        logger.debug("commitDirectories: - %s is now this"%fobj)
-                        haschanged = True
-                    else:
+                    # the directory's childrens are processed later, when the walk gets there.
+                    nodes[childRel] = (dir, dirnew)
+                # let's handle file changes.
+                elif item.is_file():
+                    fobj = None if isnew else files.get(item.name)
+                    # file is already in database, it will be checked for modifications once the tree is walked.
+                    if fobj is not None:
+                        logger.debug("commitDirectories: Found file %s (working in %s)"%(fobj, relPath))
                         # we touch fobj, so as to avoid its deletion.
-                        # but the directory has not changed.
-                        logger.debug("commitDirectories: - %s has not changed."%fobj)
                         fobj.touch()
-                # file not in database, we just add it...
-                else:
-                    fobj = VerConFile(item.name, self.getBaseDir(), self.getDataDir(), relPath)
-                    fobj.createAtRevision(newcommit)
-                    rdir.addContentFile("", item.name, fobj)
-                    logger.debug("commitDirectories: we add file %s"%item.name)
+                        known.append((fobj, item.stat()))
+                    # file not in database, we just add it...
+                    else:
+                        fobj = VerConFile(item.name, self.getBaseDir(), self.getDataDir(), relPath)
+                        fobj.createAtRevision(newcommit)
+                        rdir.addContentFile("", item.name, fobj)
+                        logger.debug("commitDirectories: we add file %s"%item.name)
+                        haschanged = True
+        
+        # the comparisons of the files are independent from one another and mostly reading files,
+        # they are run in a pool of threads.
+        if len(known) > 0:
+            with ThreadPoolExecutor(max_workers=min(len(known), os.cpu_count() or 1)) as executor:
+                futures = [executor.submit(fobj.isModified, stinfo) for fobj, stinfo in known]
+            for (fobj, stinfo), future in zip(known, futures):
+                if future.result():
+                    logger.debug("commitDirectories: - %s has changed."%fobj)
+                    # the change itself is done by changeFiles.
+                    changed.append(fobj)
                     haschanged = True
+                else:
+                    # but the directory has not changed.
+                    logger.debug("commitDirectories: - %s has not changed."%fobj)
                             
         if haschanged:
             return newcommit
@@ -1635,15 +2258,13 @@ class VerConRepository():
             v0 : only a verbose list.
             v1 : implemented level 1, level 2 not just yet.
         """
-        data = []
         with open(os.path.join(self.repodir, "commits.txt"),"r", encoding="utf-8", newline='') as f:
-            for line in f.readlines():
-                if verbose > 0:
-                    data.append(line)
-                else:
-                    if not line.startswith("  "):
-                        data.append(line)
-        return "".join(data)
+            # everything is returned, the file is read as a whole.
+            if verbose > 0:
+                return f.read()
+            # otherwise the detail lines (they start with two spaces) are removed in a single pass of the regexp
+            # engine, instead of testing each line in Python.
+            return LOG_DETAIL_RE.sub("", f.read())
         
     def restoreTo(self, revision=None, filter=".*"):
         """ reverts change to a given revision.
@@ -1658,18 +2279,22 @@ class VerConRepository():
                     last commit.
         filter: a regular expression that will match file(s) or directory(ies) to be reverted.
                     This matches to the path. THe default will match all files and directories.
+                    The default (or None) is not compiled nor matched against each file, since it takes everything.
         """
         
-        if revision == None or revision == self.lastcommit:
+        if revision is None or revision == self.lastcommit:
             revision = self.lastcommit
         
         if revision > self.lastcommit or revision <= 0:
             raise VerConError("Trying to revert to a revision %d that has not been yet created"%revision)
         
-        try:
-            match = re.compile(filter, re.I)
-        except re.error:
-            raise VerConError("Invalid filter provided %s"%filter)
+        if filter is None or filter == ".*":
+            match = None
+        else:
+            try:
+                match = re.compile(filter, re.I)
+            except re.error:
+                raise VerConError("Invalid filter provided %s"%filter)
         
         self.dirDb.restoreTo(revision, match, self.getBaseDir())
         
@@ -1682,44 +2307,51 @@ class VerConRepository():
         If not called, all committed files will be committed as "new".
         
         It is also in charge of updating the last revision if one is found to be higher than the existing.
-        """
-        regevent = re.compile("^([EH][BT]|D)(\d+)- (.+)$", re.I)
-        regin = re.compile("^([EH])([BT])", re.I)
-        for item in os.scandir(os.path.join(dataDir, relPath)):
-            if item.is_file():
-                logger.debug("precomputeFileDB: found file %s"%item.name)
-                match = regevent.match(item.name)
-                if match != None:
-                    evt = match.group(1)
-                    rev = int(match.group(2))
-                    name = match.group(3)
+        
+        The directories browsed are the ones of the directory database (loaded from metadatadir.txt) under relPath,
+        each one with a single os.scandir of its data directory: the files found are added directly to their
+        directory node, without looking it up again from the root for each file.
+        """
+        # the data directory with a trailing separator, the paths of the nodes are appended to it.
+        dataPrefix = os.path.join(dataDir, "")
+        stack = [self.dirDb.atPath(relPath)]
+        while len(stack) > 0:
+            node = stack.pop()
+            stack.extend(node.children.values())
+            nodePath = node.getPath()
+            try:
+                # the directory is closed as soon as it is listed, like in walkUserTree.
+                with os.scandir(dataPrefix + nodePath) as it:
+                    entries = list(it)
+            except FileNotFoundError:
+                logger.debug("precomputeFileDB: no data directory for %s"%nodePath)
+                continue
+            for item in entries:
+                # the name is checked first: the backups and other names are skipped without asking for their type.
+                match = EVENT_RE.match(item.name)
+                if match is not None and item.is_file():
+                    logger.debug("precomputeFileDB: found file %s"%item.name)
+                    deleted, evt, typ, rev, name = match.groups()
+                    rev = int(rev)
+                    # interned, like the directory names (see VerConDirectory).
+                    name = sys.intern(name)
                     
                     if rev > self.lastcommit:
                         self.lastcommit = rev
                         # print("self.lastcommit is now at revision %d"%rev)
                     
-                    obj = self.getFileObject(relPath, name)
+                    obj = node.findContentFile("", name)
                     
                     # no object, we create a new one.
-                    if obj == None:
-                        obj = VerConFile(name, self.getBaseDir(), self.getDataDir(), relPath)
-                        self.dirDb.addContentFile(relPath, name, obj)
+                    if obj is None:
+                        obj = VerConFile(name, self.getBaseDir(), self.getDataDir(), nodePath)
+                        node.addContentFile("", name, obj)
                         
-                    if evt == "D":
+                    # the kind of event is known from the same match.
+                    if deleted is not None:
                         obj.loadEvent("d", rev, "b", item.name)
-                    
                     else:
-                        match = regin.match(evt)
-                        if match == None:
-                            raise VerConError("Honestly I have no idea how you landed here.")
-                        
-                        evt = match.group(1).lower()
-                        typ = match.group(2).lower()
-                        
-                        obj.loadEvent(evt, rev, typ, item.name)
-            if item.is_dir():
-                logger.debug("precomputeFileDB: recursing in %s"%item.name)
-                self.precomputeFileDB(dataDir, os.path.join(relPath, item.name))
+                        obj.loadEvent(evt.lower(), rev, typ.lower(), item.name)
                 
         
     def getFileObject(self, path, name):
@@ -1738,30 +2370,81 @@ class VerConRepository():
         
         This should be called before the begin of a commit.
         
-        LOCK stores the revision number of the new commit.
+        LOCK stores the revision number of the new commit, and (on POSIX systems) it stays open with an advisory lock
+        until unlockRepository, so that other processes can tell a running commit from a crashed one.
+        The file is created, locked and written under a temporary name, then hard linked as LOCK: LOCK never exists
+        empty or unlocked, and the link fails if it already exists, so that two processes cannot both start a commit.
         """
-        if os.path.isfile(os.path.join(self.getRepoDir(), "LOCK")):
+        lockPath = os.path.join(self.getRepoDir(), "LOCK")
+        # a new name each time, even for two lockers of the same process, never one left by a crash.
+        fd, tempPath = tempfile.mkstemp(prefix="LOCK.", dir=self.getRepoDir())
+        try:
+            # mkstemp makes it private, LOCK is readable like the other files of the repository.
+            os.chmod(tempPath, 0o644)
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            os.write(fd, ("%d"%(self.getLastCommit() + 1)).encode("utf-8"))
+            os.fsync(fd)
+            os.link(tempPath, lockPath)
+        except FileExistsError:
+            os.close(fd)
             raise VerConError("LOCKed repository, something went wrong, this should never happen when this function is called. recover() should be called to clean first.")
-        with open(os.path.join(self.getRepoDir(), "LOCK"), "w", encoding="utf-8", newline='') as f:
-            f.write("%d"%(self.getLastCommit() + 1))
+        except OSError as e:
+            os.close(fd)
+            raise VerConError("Cannot lock the repository: %s"%e)
+        finally:
+            os.unlink(tempPath)
+        self.lockfd = fd
         
     def unlockRepository(self):
         """
         Removes the LOCK file, indicating that the repository is clean.
+        
+        With an advisory lock, the file is removed before being closed, so that nobody can see it unlocked
+        while it still exists.
         """
-        os.unlink(os.path.join(self.getRepoDir(), "LOCK"))
+        if self.lockfd is not None and fcntl is not None:
+            os.unlink(os.path.join(self.getRepoDir(), "LOCK"))
+            os.close(self.lockfd)
+        else:
+            if self.lockfd is not None:
+                os.close(self.lockfd)
+            os.unlink(os.path.join(self.getRepoDir(), "LOCK"))
+        self.lockfd = None
 
     def isDirty(self):
         """
         Returns a revision number if the LOCK file is present, thus indicating the last commit did not go to completion,
-        or -1 if lock file is absent.
+        or -1 if lock file is absent. An empty LOCK that nobody holds is a crash before the commit began: 0 is returned.
+        
+        Raises VerConError if the LOCK file is held by another process, which means a commit is still running.
         """
-        rev = -1
-        if os.path.isfile(os.path.join(self.getRepoDir(), "LOCK")):
-            with open(os.path.join(self.getRepoDir(), "LOCK"), "r", encoding="utf-8", newline='') as f:
-                rev = int(f.read())
-
-        return rev
+        lockPath = os.path.join(self.getRepoDir(), "LOCK")
+        while True:
+            try:
+                f = open(lockPath, "r", encoding="utf-8", newline='')
+            except FileNotFoundError:
+                return -1
+            with f:
+                if fcntl is not None:
+                    try:
+                        fcntl.flock(f.fileno(), fcntl.LOCK_SH | fcntl.LOCK_NB)
+                    except OSError:
+                        raise VerConError("Another process is committing to this repository, please retry later.")
+                    # unlockRepository removes LOCK before releasing it: if it is gone or replaced since we opened it,
+                    # that commit went to completion.
+                    try:
+                        current = os.stat(lockPath)
+                    except FileNotFoundError:
+                        return -1
+                    if not os.path.samestat(current, os.fstat(f.fileno())):
+                        continue
+                data = f.read()
+            # nobody holds it: an empty LOCK is left by a crash before anything was written (or by an older version
+            # that created it before writing it), revision 0 has nothing to restore and the LOCK is then removed.
+            if data == "":
+                return 0
+            return int(data)
 
     def recover(self, revision):
         """
@@ -1778,35 +2461,35 @@ class VerConRepository():
             for f in files:
                 logger.debug("recover: %s"%os.path.join(root, f))
         
-        bakRe = re.compile("^BAK%d- (.*)"%revision)
-        newRe = re.compile("^(?:EB|ET)%d-"%revision)
-        typRe = re.compile("^(?:EB|ET|D)(\d+)- (.*)")
+        # these depend on the revision recovered, they are compiled for each recovery.
+        bakRe = re.compile(r"^BAK%d- (.*)"%revision)
+        newRe = re.compile(r"^(?:EB|ET)%d-"%revision)
         restorable = {}
         deletable  = {}
         
         for root, dirs, files in os.walk(self.getRepoDir()):
             for f in files:
                 res = bakRe.match(f)
-                if res != None:
-                    if root in restorable.keys():
+                if res is not None:
+                    if root in restorable:
                         restorable[root].append((f, res.group(1)))
                     else:
                         restorable[root] = [(f, res.group(1))]
                 res = newRe.match(f)
-                if res != None:
-                    if root in deletable.keys():
+                if res is not None:
+                    if root in deletable:
                         deletable[root].append(f)
                     else:
                         deletable[root] = [f]                    
 
         # now we have a dictionnary of directory, [ (list of  restorable files in the directory, original file name) ], we can do our replace.
         
-        for d in restorable.keys():
+        for d in restorable:
             for (f, n) in restorable[d]:
                 # if it's a data file (ETx, EBx, Dx), we need to delete a potential history file so as not to cause a conflict.
-                res = typRe.match(n)
+                res = STORED_RE.match(n)
                 # res will be None for commits.txt and metadatadir.txt
-                if res != None:
+                if res is not None:
                     # we need to delete the history file corresponding to the revision of the file restored - if it exists.
                     # we do not know the type of the previous revision and we need to consider both.
                     rev = int(res.group(1))
@@ -1823,11 +2506,14 @@ class VerConRepository():
                         if os.path.isfile(os.path.join(d, test)):
                             os.unlink(os.path.join(d, test))
 
-                # then finally we restore the file itself.
+                # then finally we restore the file itself. The backup may be a hard link to a file that is still
+                # there (see createBackup), os.replace would then do nothing: the file is removed first.
+                if os.path.isfile(os.path.join(d, n)):
+                    os.unlink(os.path.join(d, n))
                 os.replace(os.path.join(d, f), os.path.join(d, n))        
         
         # finally we delete the new files that have not been processed above.
-        for d in deletable.keys():
+        for d in deletable:
             for f in deletable[d]:
                 if os.path.isfile(os.path.join(d, f)):
                     os.unlink(os.path.join(d, f))
@@ -1845,11 +2531,10 @@ class VerConRepository():
         """
         if os.path.isfile(os.path.join(self.getRepoDir(), "LOCK")):
             raise VerConError("LOCKed repository, you should not do cleanup if the state is dirty.")
-        bakre = re.compile("^BAK(\d+)-")
         for root, dirs, files in os.walk(self.getRepoDir()):
             for f in files:
-                res = bakre.match(f)
-                if res != None:
+                res = BACKUP_RE.match(f)
+                if res is not None:
                     rev = int(res.group(1))
                     if rev < revision:
                         os.unlink(os.path.join(root, f))
@@ -1857,9 +2542,16 @@ class VerConRepository():
         
     def __repr__(self):
         """
-        Pretty print, for debug purposes.
+        Short description of the repository: it may end up in tracebacks or log messages, so the directory database
+        is not walked here (see debugRepr).
+        """
+        return "VerConRepository: last revision %d"%self.lastcommit
+        
+    def debugRepr(self):
+        """
+        Pretty print, for debug purposes: the description of the repository followed by its whole directory database.
         """
-        return "VerConRepository: last revision %d, directory database:\n%s"%(self.lastcommit, "\n".join(self.dirDb.Serialize(debug=True)))
+        return "%r, directory database:\n%s"%(self, "\n".join(self.dirDb.iterSerialize(debug=True)))
 
         
 if __name__ == "__main__":
@@ -1885,17 +2577,17 @@ if __name__ == "__main__":
         elif sys.argv[1].lower() == "revert":
             revision = None
             filter = ".*"
-            if len(sys.argv) == 3:
+            if len(sys.argv) >= 3:
                 revision = int(sys.argv[2])
-            if len(sys.argv) == 4:
-                filter = sys.argv[4]
+            if len(sys.argv) >= 4:
+                filter = sys.argv[3]
 
             vc = VerConRepository(".")
-            vc.revertTo(revision, filter)
+            vc.restoreTo(revision, filter)
 
         elif sys.argv[1].lower() == "list":
             vc = VerConRepository(".")
-            if len(sys.argv) == 3 and sys.argv[2].lower() == "verbose":
+            if len(sys.argv) >= 3 and sys.argv[2].lower() == "verbose":
                 print(vc.list(1))
             else:
                 print(vc.list())